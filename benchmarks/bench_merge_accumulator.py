@@ -0,0 +1,63 @@
+"""
+Micro-benchmark of merging the submissions of the forms in a form group
+
+Compares the deepcopy accumulation that fetch_merge_data used, which copies the growing dataset for every form version,
+with appending each version's submissions to one list. Runs without django:
+
+    python benchmarks/bench_merge_accumulator.py [no_versions] [submissions_per_version]
+"""
+import copy
+import itertools
+import random
+import sys
+import time
+
+
+def create_submission(pk, no_repeats):
+    # a flattened submission with a repeat group, like those from get_form_submissions_as_json
+    submission = dict(('q%d' % i, str(random.randint(0, 1000))) for i in range(40))
+    submission['unique_id'] = 'hh_%d' % pk
+    submission['animals'] = [
+        {'unique_id': 'animals_%d' % (pk * no_repeats + j), 'top_id': 'hh_%d' % pk, 'parent_id': 'hh_%d' % pk, 'breed': 'local', 'age': str(j)}
+        for j in range(no_repeats)
+    ]
+    return submission
+
+
+def deepcopy_merge(versions):
+    all_submissions = []
+    for this_submissions in versions:
+        all_submissions = copy.deepcopy(all_submissions) + copy.deepcopy(this_submissions)
+    return all_submissions
+
+
+def extend_merge(versions):
+    all_submissions = []
+    for this_submissions in versions:
+        all_submissions.extend(this_submissions)
+    return all_submissions
+
+
+def chain_merge(versions):
+    return list(itertools.chain.from_iterable(versions))
+
+
+def bench(name, merge, versions):
+    start = time.perf_counter()
+    merged = merge(versions)
+    elapsed = time.perf_counter() - start
+    print('%-16s %8d submissions  %.4fs' % (name, len(merged), elapsed))
+    return elapsed
+
+
+if __name__ == '__main__':
+    no_versions = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    per_version = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    random.seed(42)
+    versions = [[create_submission(v * per_version + i, 3) for i in range(per_version)] for v in range(no_versions)]
+    print('Merging %d form versions of %d submissions each' % (no_versions, per_version))
+
+    legacy = bench('deepcopy', deepcopy_merge, versions)
+    extended = bench('extend', extend_merge, versions)
+    chained = bench('chain', chain_merge, versions)
+    print('Speed up: %.0fx (extend), %.0fx (chain)' % (legacy / extended, legacy / chained))
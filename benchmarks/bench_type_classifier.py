@@ -0,0 +1,55 @@
+"""
+Micro-benchmark of the submission value classification
+
+Compares determine_type, which tries every value as a number and then as json, with the TypeClassifier, which uses
+the question types of the form structure. Runs without django:
+
+    python benchmarks/bench_type_classifier.py [no_submissions]
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from type_classifier import TypeClassifier
+
+
+def create_form(no_questions):
+    # a flat processed structure like the one saved for an Ona form
+    question_types = ['select one'] * 3 + ['integer'] * 2 + ['text'] * 3 + ['date', 'calculate']
+    return [{'id': i, 'parent_id': 0, 'name': 'q%d' % i, 'label': 'Question %d' % i, 'type': question_types[i % len(question_types)]} for i in range(no_questions)]
+
+
+def create_answer(question):
+    if question['type'] == 'select one':
+        return str(random.randint(1, 5))
+    elif question['type'] == 'integer':
+        return str(random.randint(0, 1000))
+    elif question['type'] == 'date':
+        return '2022-10-%02d' % random.randint(1, 28)
+    elif question['type'] == 'calculate':
+        return random.choice(['yes', 'no', '12.5'])
+    return random.choice(['Nairobi', 'some free text answer', 'N/A', 'true'])
+
+
+def bench(name, classify, values):
+    start = time.perf_counter()
+    for key, value in values:
+        classify(value, key)
+    elapsed = time.perf_counter() - start
+    print('%-16s %10.0f values/s  (%.2fs)' % (name, len(values) / elapsed, elapsed))
+    return elapsed
+
+
+if __name__ == '__main__':
+    no_submissions = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    random.seed(42)
+    form = create_form(300)
+    values = [(question['name'], create_answer(question)) for i in range(no_submissions) for question in form]
+    print('Classifying %d values from %d submissions' % (len(values), no_submissions))
+
+    classifier = TypeClassifier(form)
+    legacy = bench('determine_type', lambda value, key: TypeClassifier.determine_type(value), values)
+    schema = bench('TypeClassifier', classifier.classify, values)
+    print('Speed up: %.1fx' % (legacy / schema))
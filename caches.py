@@ -0,0 +1,167 @@
+import threading
+import uuid
+
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from .models import SystemSettings, DictionaryItems
+
+
+def invalidate_on_commit(cache_class):
+    """
+    Invalidate a cache once the current transaction is committed
+
+    Invalidating before the commit lets the other processes cache the old rows again until the next change. Outside a
+    transaction the cache is invalidated right away. A connection in manual transaction management can't defer it, so
+    the cache is invalidated right away and the code making the commit should invalidate it again after committing
+
+    Args:
+        cache_class (class): SettingsCache or DictionaryCache
+    """
+    connection = transaction.get_connection()
+    if not connection.in_atomic_block and not connection.get_autocommit():
+        cache_class.invalidate()
+        return
+
+    transaction.on_commit(cache_class.invalidate)
+
+
+class SettingsCache():
+    """
+    A process-wide snapshot of the system settings, so that creating a parser doesn't query the settings table
+
+    The snapshot is tagged with a version saved in the django cache. Saving or deleting a setting changes the version
+    (see the SystemSettings signal receivers in models) once the change is committed, so every process reloads its
+    snapshot on the next access. With a shared cache backend the invalidation reaches all the processes, with the
+    default local memory cache only the process which made the change. Queryset updates bypass the signals and should
+    call invalidate_on_commit()
+
+    Settings (all optional):
+        SYSTEM_SETTINGS_CACHE: Set to False to always read the settings from the database. Defaults to True
+    """
+    version_key = 'odk_parser:system_settings:version'
+    _snapshot = None
+    _version = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def get_all(cls):
+        """
+        Get all the system settings
+
+        Returns:
+            dict: The setting values keyed by the setting keys. It is a copy, so it can be changed by the caller
+        """
+        if not getattr(settings, 'SYSTEM_SETTINGS_CACHE', True):
+            return cls.load_settings()
+
+        with cls._lock:
+            version = cache.get(cls.version_key)
+            if version is None:
+                # the version has been evicted or never set, so we can't tell whether the snapshot is current
+                version = uuid.uuid4().hex
+                cache.set(cls.version_key, version, None)
+
+            if cls._snapshot is None or cls._version != version:
+                cls._snapshot = cls.load_settings()
+                cls._version = version
+
+            return dict(cls._snapshot)
+
+    @classmethod
+    def invalidate(cls):
+        # a new version makes all the snapshots stale
+        with cls._lock:
+            cls._snapshot = None
+            cache.set(cls.version_key, uuid.uuid4().hex, None)
+
+    @classmethod
+    def load_settings(cls):
+        all_settings = {}
+        for setting in SystemSettings.objects.all().values('setting_key', 'setting_value'):
+            all_settings[setting['setting_key']] = setting['setting_value']
+
+        return all_settings
+
+
+class DictionaryCache():
+    """
+    A process-wide LRU cache of the dictionary labels, keyed by the dictionary keys
+
+    Like the settings snapshot, the cached labels are tagged with a version in the django cache, which is changed when
+    a dictionary item is saved or deleted (see the DictionaryItems signal receivers in models). Bulk inserts don't
+    send the signals, so the code making them should call invalidate_on_commit()
+
+    Settings (all optional):
+        DICTIONARY_CACHE_SIZE: The maximum number of labels to keep. Defaults to 10000
+    """
+    version_key = 'odk_parser:dictionary_items:version'
+    _labels = OrderedDict()
+    _version = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def get_values(cls, t_keys):
+        """
+        Get the labels of the dictionary keys, fetching the ones which are not cached with one query
+
+        Args:
+            t_keys (list): The dictionary keys
+
+        Returns:
+            dict: The labels keyed by the dictionary keys. Keys which are not in the dictionary are left out
+        """
+        t_keys = set(t_keys)
+        t_values = {}
+        with cls._lock:
+            cls.check_version()
+            for t_key in t_keys:
+                if t_key in cls._labels:
+                    cls._labels.move_to_end(t_key)
+                    t_values[t_key] = cls._labels[t_key]
+            fetch_version = cls._version
+
+        missing_keys = [t_key for t_key in t_keys if t_key not in t_values]
+        if len(missing_keys) != 0:
+            fetched = dict((t_key, None) for t_key in missing_keys)
+            for i in range(0, len(missing_keys), 500):
+                # the items are ordered so that the first saved label of a key is used when a key is in several groups
+                dict_items = DictionaryItems.objects.filter(t_key__in=missing_keys[i:i + 500]).order_by('-id').values_list('t_key', 't_value')
+                for t_key, t_value in dict_items:
+                    fetched[t_key] = t_value
+
+            with cls._lock:
+                # the missing keys are cached too, as None, so that they are not queried again. Unless the dictionary
+                # changed while they were being fetched
+                cls.check_version()
+                if cls._version == fetch_version:
+                    max_size = getattr(settings, 'DICTIONARY_CACHE_SIZE', 10000)
+                    for t_key, t_value in fetched.items():
+                        cls._labels[t_key] = t_value
+                        cls._labels.move_to_end(t_key)
+                    while len(cls._labels) > max_size:
+                        cls._labels.popitem(last=False)
+
+            t_values.update(fetched)
+
+        return dict((t_key, t_value) for t_key, t_value in t_values.items() if t_value is not None)
+
+    @classmethod
+    def check_version(cls):
+        # drop the cached labels if the dictionary has changed. Should be called with the lock held
+        version = cache.get(cls.version_key)
+        if version is None:
+            version = uuid.uuid4().hex
+            cache.set(cls.version_key, version, None)
+
+        if cls._version != version:
+            cls._labels.clear()
+            cls._version = version
+
+    @classmethod
+    def invalidate(cls):
+        with cls._lock:
+            cls._labels.clear()
+            cache.set(cls.version_key, uuid.uuid4().hex, None)
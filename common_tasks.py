@@ -8,6 +8,7 @@ import boto3
 import json
 import sentry_sdk
 
+from functools import lru_cache
 from botocore.exceptions import ClientError
 from django.conf import settings
 from decimal import Decimal
@@ -263,3 +264,36 @@ def process_geopoint_node_v1(column, gps_string):
         return geo[3]
 
     raise Exception('Unknown Destination Column: Encountered a GPS data field (%s), but I cant seem to deduce which type(latitude, longitude, altitude) the current column (%s) is.' % (gps_string, column))
+
+
+# the sane(last) part of the keys of a submission, e.g. 'group/question' => 'question'
+json_key_pattern = re.compile(r"/?([\.\w\-]+)$")
+
+
+@lru_cache(maxsize=getattr(settings, 'JSON_KEY_CACHE_SIZE', 8192))
+def clean_json_key(j_key):
+    """
+    Given a key from a submission, get the sane(last) part of the key
+
+    The keys of a form are few and repeat in every submission, so the clean keys are cached. The cache is shared by
+    the parsers of the process and bounded by the JSON_KEY_CACHE_SIZE setting (defaults to 8192)
+    """
+    return json_key_pattern.findall(j_key)[0]
+
+
+def json_key_cache_stats():
+    """
+    Get the counters of the clean_json_key cache
+
+    Returns:
+        dict: The hits, misses, current size, maximum size and the hit rate of the cache
+    """
+    info = clean_json_key.cache_info()
+    lookups = info.hits + info.misses
+    return {
+        'hits': info.hits,
+        'misses': info.misses,
+        'size': info.currsize,
+        'max_size': info.maxsize,
+        'hit_rate': info.hits / lookups if lookups else 0.0
+    }
@@ -6,111 +6,204 @@ import six
 import os
 import csv
 import re
+import shutil
+import tempfile
+import zipfile
 
+from django.conf import settings
 from vendor.terminal_output import Terminal
 from pyexcelerate import Workbook
 
+# xlsxwriter is optional, it writes the rows of a sheet to the file as they are added
+try:
+    import xlsxwriter
+except Exception:
+    xlsxwriter = None
+
+# pyarrow is optional, it is used for the parquet exports
+try:
+    import pyarrow
+    import pyarrow.parquet
+except Exception:
+    pyarrow = None
+
 terminal = Terminal()
 # reload(sys)
 # sys.setdefaultencoding('utf8')
 
+# the range of the parquet integer columns
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
+
+
+class IntegerOverflowError(Exception):
+    # raised when a value of an integer column doesn't fit in a parquet int64 column
+    def __init__(self, field, value):
+        super(IntegerOverflowError, self).__init__("The value '%s' of %s doesn't fit in a 64 bit integer" % (value, field))
+        self.field = field
+
+
+def split_sheet_rows(sheet_name, record, repeat_sheets, add_cols_data=None):
+    """
+    Split a flattened record to the rows of its sheets
+
+    The repeats of the record are replaced by a link to their sheet and their records become rows of that sheet. The
+    record row is yielded first, followed by the rows of its repeats. Other list values are kept in the row
+
+    Args:
+        sheet_name (string): The sheet of the record
+        record (dict): The flattened record, with the repeats as lists of records
+        repeat_sheets (dict or set): The sheets of the output structure. Only the list fields named after a sheet are
+            repeats
+        add_cols_data (dict, optional): The values of the ADD_MAIN_COLS columns of the submission, added to its rows
+
+    Yields:
+        tuple: The sheet name and the row
+    """
+    row = {}
+    repeats = []
+    for field, value in six.iteritems(record):
+        if isinstance(value, list) and field in repeat_sheets:
+            repeats.append((field, value))
+            row[field] = 'Check ' + field
+        else:
+            row[field] = value
+
+    if add_cols_data:
+        # the repeats show the main columns of their submission
+        for field, value in six.iteritems(add_cols_data):
+            row.setdefault(field, value)
+
+    yield sheet_name, row
+    for repeat_name, repeat_records in repeats:
+        yield from split_repeat_rows(repeat_name, repeat_records, repeat_sheets, add_cols_data)
+
+
+def split_repeat_rows(sheet_name, records, repeat_sheets, add_cols_data):
+    for record in records:
+        if isinstance(record, dict):
+            yield from split_sheet_rows(sheet_name, record, repeat_sheets, add_cols_data)
+        elif isinstance(record, list):
+            yield from split_repeat_rows(sheet_name, record, repeat_sheets, add_cols_data)
+
 
 class ExcelWriter():
-    def __init__(self, workbook_name, this_format='xlsx', directory='./'):
+    """
+    Writes the flattened submissions to an xlsx workbook, to a csv file per sheet or to a zip of parquet files per sheet
+
+    The parquet columns of numeric questions are typed as integers or floats, using the column types given by the
+    parser. The other columns are text
+
+    Settings (all optional):
+        EXCEL_WRITER_ENGINE: 'pyexcelerate' builds the workbook in memory and is the fastest for small exports.
+            'xlsxwriter' writes the rows in constant memory mode, so the memory used stays flat for large exports.
+            Defaults to 'pyexcelerate'
+        EXCEL_MAX_SHEET_ROWS: The maximum number of rows of a worksheet, including the header. The rows of a sheet past
+            it are written to <sheet>_2, <sheet>_3 and so on. Defaults to 1048576, the xlsx limit
+        PARQUET_BATCH_SIZE: The number of rows converted and written to a parquet file at a time. Defaults to 50000
+    """
+    def __init__(self, workbook_name, this_format='xlsx', directory='./', engine=None, column_types=None):
         self.wb_name = workbook_name
         self.format = this_format
         self.save_dir = directory
-        self.pending_processing = {}
-        self.pending_processing_tmp = {}
+        if not self.is_format_supported(self.format):
+            raise Exception("pyarrow is needed to export the data as parquet files")
+        # the numeric question type (integer, decimal or range) of the numeric columns, for typing the parquet columns
+        self.column_types = dict(column_types) if column_types is not None else {}
+        self.engine = engine if engine is not None else getattr(settings, 'EXCEL_WRITER_ENGINE', 'pyexcelerate')
+        if self.engine == 'xlsxwriter' and xlsxwriter is None:
+            terminal.tprint("\txlsxwriter is not installed, using pyexcelerate to write the workbook", 'warn')
+            self.engine = 'pyexcelerate'
         self.sorted_sheet_fields = {}
         self.sheet_attrs = {}
         self.sheet_attr_names = []
+        # the lower case names of the worksheets, used to name the parts of the long sheets
+        self.worksheet_names = set()
+        # temporary files with the rows of each sheet, in the order that the sheets are found, when streaming the rows
+        self.spools = {}
+
+    @staticmethod
+    def is_format_supported(this_format):
+        # the parquet format needs the optional pyarrow
+        return this_format != 'parquet' or pyarrow is not None
 
-    def create_workbook(self, data, structure, sheet_attrs, sheet_attr_names):
+    def create_workbook(self, data, structure, sheet_attrs=None, sheet_attr_names=None):
         # given the data as json and the structure as json too, create a workbook with this data
 
-        self.wb = Workbook()
-        self.sheet_attrs = sheet_attrs
-        self.sheet_attr_names = sheet_attr_names
-        # print(sheet_attrs)
-        # order the fields for proper display
-        for sheet_name, sheet_fields in six.iteritems(structure):
-            self.sorted_sheet_fields[sheet_name] = self.order_fields(sheet_fields, sheet_attr_names)
+        # the records are split to the rows of their sheets in one pass, the rows are spooled until the sheets are written
+        self.sheet_attrs = sheet_attrs if sheet_attrs is not None else {}
+        try:
+            for record in data:
+                for sheet_name, row in split_sheet_rows('main', record, structure, self.sheet_attrs.get(record.get('unique_id'))):
+                    self.add_row(sheet_name, row)
+        except Exception:
+            self.close_spools()
+            raise
 
-        self.pending_processing['main'] = {'data': data, 'is_processed': False}
+        self.save_spooled_workbook(structure, sheet_attr_names if sheet_attr_names is not None else [])
+        return False
 
-        # from the docs: https://docs.python.org/2.7/tutorial/datastructures.html#dictionaries
-        # It is sometimes tempting to change a list while you are looping over it;
-        # however, it is often simpler and safer to create a new list instead
-        # so lets not change the list while iterating
-        while len(list(self.pending_processing.keys())) != 0:
-            all_processed = True
-            for sheet_name, data in six.iteritems(self.pending_processing):
-                if data['is_processed'] is False:
-                    terminal.tprint('Processing ' + sheet_name, 'okblue')
-                    all_processed = False
-                    self.process_and_write(data['data'], sheet_name)
-                    # mark it as processed
-                    self.pending_processing[sheet_name]['is_processed'] = True
-                    break
+    def open_workbook(self):
+        if self.format == 'parquet':
+            # the parquet files are written to a temporary directory and zipped when saving
+            self.parquet_dir = tempfile.mkdtemp()
+            self.parquet_files = []
+            self.conversion_failures = {}
+            self.wb = None
+        elif self.format == 'xlsx' and self.engine == 'xlsxwriter':
+            # in constant memory mode the rows are flushed to the file as each row is completed
+            self.wb = xlsxwriter.Workbook(self.wb_name, {'constant_memory': True, 'strings_to_urls': False})
+        else:
+            self.wb = Workbook()
 
-            if all_processed is True:
-                break
+    def save_workbook(self):
+        if self.format == 'parquet':
+            # the parquet files are compressed already, so they are stored as is
+            with zipfile.ZipFile(self.wb_name, 'w', zipfile.ZIP_STORED) as zip_file:
+                for filename in self.parquet_files:
+                    zip_file.write(os.path.join(self.parquet_dir, filename), filename)
+            return
 
-        if self.format == 'xlsx':
-            self.wb.save(self.wb_name)
-        return False
+        if self.format != 'xlsx':
+            return
 
-    def process_and_write(self, data, sheet_name):
-        # contains 2D array of all the data for the current sheet
-        cur_records = []
-        cur_records.append(self.sorted_sheet_fields[sheet_name])
+        if self.engine == 'xlsxwriter':
+            self.wb.close()
+        else:
+            self.wb.save(self.wb_name)
 
-        for record in data:
-            # contains 1D array of data for the current record data
-            this_record = []
-            for field in self.sorted_sheet_fields[sheet_name]:
-                try:
-                    cur_value = record[field]
-                except KeyError:
-                    if field in self.sheet_attr_names:
-                        # we have the data in the main attrs
-                        item_pk = 'top_id' if 'top_id' in record.keys() else 'unique_id'
-                        cur_value = self.sheet_attrs[record[item_pk]][field]
-                    else:
-                        cur_value = '-'
-
-                if isinstance(cur_value, list) is True:
-                    # defer processing
-                    if field not in self.pending_processing:
-                        terminal.tprint("\tFound new sheet (%s) data to save. Deferring for now." % field, 'warn')
-                        self.pending_processing[field] = {'data': [], 'is_processed': False}
-
-                    self.pending_processing[field]['data'].extend(cur_value)
-                    # add a link
-                    this_record.append('Check ' + field)
-                else:
-                    this_record.append(cur_value)
-
-            cur_records.append(this_record)
-
-        # now lets do a batch write of our data
-        # terminal.tprint("\tBatch writing of " + sheet_name, 'ok')
-        # terminal.tprint(json.dumps(cur_records), 'warn')
+    def write_sheet(self, sheet_name, cur_records):
+        # write the header and rows of a sheet to the workbook or its csv file. The records can be a generator
         if self.format == 'xlsx':
-            if len(sheet_name) > 31:
-                # if the worksheet name is > 31 chars rename it to a shorter name due to Excel worksheet name restrictions
-                # https://stackoverflow.com/questions/3681868/is-there-a-limit-on-an-excel-worksheets-name-length
-                # we rename the worksheet by retaining the first 2 parts from s7p10q1_rpt_chicken_hlth_service ==> s7p10q1_rpt
-                matches = re.findall(r'^(s[\d_\.]+p[\d_\.]+q[\d_\.]+?_)(rpt)?', sheet_name)
-                matches = list(matches[0])
-                if len(matches) == 2:
-                    final_sheet_name = str(matches[0]) + str(matches[1])
-                elif len(matches) == 1:
-                    final_sheet_name = str(matches[0])
+            final_sheet_name = self.worksheet_name(sheet_name)
+
+            # a worksheet holds a limited number of rows, so the rows past the limit roll over to <sheet>_2, <sheet>_3...
+            max_rows = getattr(settings, 'EXCEL_MAX_SHEET_ROWS', 1048576)
+            cur_records = iter(cur_records)
+            header = next(cur_records)
+            part = 1
+            if self.engine == 'xlsxwriter':
+                worksheet = self.add_worksheet_part(final_sheet_name, part, header)
+                row_index = 1
+                for record in cur_records:
+                    if row_index == max_rows:
+                        part += 1
+                        worksheet = self.add_worksheet_part(final_sheet_name, part, header)
+                        row_index = 1
+                    worksheet.write_row(row_index, 0, [self.cell_value(value) for value in record])
+                    row_index += 1
             else:
-                final_sheet_name = sheet_name
-            self.wb.new_sheet(final_sheet_name, data=cur_records)
+                part_records = [header]
+                for record in cur_records:
+                    if len(part_records) == max_rows:
+                        self.wb.new_sheet(self.sheet_part_name(final_sheet_name, part), data=part_records)
+                        part += 1
+                        part_records = [header]
+                    part_records.append(record)
+                self.wb.new_sheet(self.sheet_part_name(final_sheet_name, part), data=part_records)
+
+        if self.format == 'parquet':
+            self.write_parquet_file(sheet_name, cur_records)
 
         if self.format == 'csv':
             filename = os.path.join(self.save_dir, '%s.%s' % (sheet_name, 'csv'))
@@ -120,6 +213,130 @@ class ExcelWriter():
                 for row in cur_records:
                     writer.writerow([s for s in row])
 
+    def write_parquet_file(self, sheet_name, cur_records):
+        # write the rows of a sheet to a parquet file, a batch of rows at a time
+        cur_records = iter(cur_records)
+        header = next(cur_records)
+        column_types = [self.column_types.get(field) for field in header]
+        schema = pyarrow.schema([(str(field), self.parquet_type(column_type)) for field, column_type in zip(header, column_types)])
+
+        filename = '%s.parquet' % sheet_name
+        writer = pyarrow.parquet.ParquetWriter(os.path.join(self.parquet_dir, filename), schema)
+        try:
+            batch_size = getattr(settings, 'PARQUET_BATCH_SIZE', 50000)
+            while True:
+                batch = [record for _, record in zip(range(batch_size), cur_records)]
+                if len(batch) == 0:
+                    break
+
+                columns = []
+                for index, column_type in enumerate(column_types):
+                    values = [self.parquet_value(record[index], column_type, header[index]) for record in batch]
+                    columns.append(pyarrow.array(values, type=schema.field(index).type))
+                writer.write_table(pyarrow.Table.from_arrays(columns, schema=schema))
+        except IntegerOverflowError:
+            # the file is written again by write_spooled_sheet, so the failures of this attempt are not reported
+            self.conversion_failures = {}
+            raise
+        finally:
+            writer.close()
+            self.report_conversion_failures(sheet_name)
+
+        self.parquet_files.append(filename)
+
+    def report_conversion_failures(self, sheet_name):
+        # warn about the values which were saved as nulls since they couldn't be converted to the type of their column
+        for field, (count, example) in six.iteritems(self.conversion_failures):
+            terminal.tprint("\t%s.%s: %d value(s) couldn't be converted to %s and were saved as nulls, e.g. '%s'" % (sheet_name, field, count, self.column_types.get(field), example), 'warn')
+        self.conversion_failures = {}
+
+    def parquet_type(self, column_type):
+        if column_type == 'integer':
+            return pyarrow.int64()
+        elif column_type in ('decimal', 'range'):
+            return pyarrow.float64()
+        return pyarrow.string()
+
+    def parquet_value(self, value, column_type, field=None):
+        # convert a value to the type of its column. In the numeric columns the placeholders of missing values are saved
+        # as nulls, as are the values which can't be converted, which are counted for report_conversion_failures. The
+        # text columns keep the placeholders
+        if value is None:
+            return None
+
+        if column_type in ('integer', 'decimal', 'range') and (value == '-' or value == 'N/A' or value == ''):
+            return None
+
+        if column_type == 'integer':
+            try:
+                int_value = int(value)
+            except (TypeError, ValueError, OverflowError):
+                try:
+                    float_value = float(value)
+                    if not float_value.is_integer():
+                        return self.conversion_failure(field, value)
+                    int_value = int(float_value)
+                except (TypeError, ValueError, OverflowError):
+                    return self.conversion_failure(field, value)
+
+            if int_value < INT64_MIN or int_value > INT64_MAX:
+                raise IntegerOverflowError(field, value)
+            return int_value
+        elif column_type in ('decimal', 'range'):
+            try:
+                return float(value)
+            except (TypeError, ValueError):
+                return self.conversion_failure(field, value)
+
+        return value if isinstance(value, six.string_types) else str(value)
+
+    def conversion_failure(self, field, value):
+        count, example = self.conversion_failures.get(field, (0, value))
+        self.conversion_failures[field] = (count + 1, example)
+        return None
+
+    def worksheet_name(self, sheet_name):
+        if len(sheet_name) <= 31:
+            return sheet_name
+
+        # if the worksheet name is > 31 chars rename it to a shorter name due to Excel worksheet name restrictions
+        # https://stackoverflow.com/questions/3681868/is-there-a-limit-on-an-excel-worksheets-name-length
+        # we rename the worksheet by retaining the first 2 parts from s7p10q1_rpt_chicken_hlth_service ==> s7p10q1_rpt
+        matches = re.findall(r'^(s[\d_\.]+p[\d_\.]+q[\d_\.]+?_)(rpt)?', sheet_name)
+        matches = list(matches[0])
+        if len(matches) == 2:
+            return str(matches[0]) + str(matches[1])
+        elif len(matches) == 1:
+            return str(matches[0])
+
+    def sheet_part_name(self, sheet_name, part):
+        # the name of a part of a sheet that has more rows than a worksheet can hold, within the 31 characters of a name.
+        # The worksheet names are case insensitive, so the suffix is increased until the name is not used by another sheet
+        if part == 1:
+            return sheet_name
+
+        while True:
+            suffix = '_%d' % part
+            part_name = sheet_name[:31 - len(suffix)] + suffix
+            if part_name.lower() not in self.worksheet_names:
+                break
+            part += 1
+
+        self.worksheet_names.add(part_name.lower())
+        terminal.tprint("\tThe sheet %s is past the worksheet row limit, continuing in %s" % (sheet_name, part_name), 'warn')
+        return part_name
+
+    def add_worksheet_part(self, sheet_name, part, header):
+        worksheet = self.wb.add_worksheet(self.sheet_part_name(sheet_name, part))
+        worksheet.write_row(0, 0, [self.cell_value(value) for value in header])
+        return worksheet
+
+    def cell_value(self, value):
+        # xlsxwriter only writes the basic types, so the other values are written as text
+        if value is None or isinstance(value, (six.string_types, int, float, bool)):
+            return value
+        return str(value)
+
     def order_fields(self, fields, add_fields):
         fields.sort()
 
@@ -144,7 +361,97 @@ class ExcelWriter():
 
         return fields
 
+    def add_row(self, sheet_name, row):
+        """
+        Spool a flattened row of a sheet to a temporary file
+
+        The rows are written to the workbook by save_spooled_workbook, once the columns of all the sheets are known. So
+        only the current row is held in memory while streaming the submissions
+
+        Args:
+            sheet_name (string): The sheet the row belongs to
+            row (dict): The row values keyed by the column names. Repeats should already be split to their own sheets
+        """
+        if sheet_name not in self.spools:
+            self.spools[sheet_name] = tempfile.TemporaryFile(mode='w+', encoding='utf-8')
+
+        self.spools[sheet_name].write(json.dumps(row, default=str) + '\n')
+
+    def checkpoint(self):
+        # the current end of each spool, used to drop the rows spooled after it
+        return dict((sheet_name, spool.tell()) for sheet_name, spool in six.iteritems(self.spools))
+
+    def rollback(self, checkpoint):
+        """
+        Drop the rows spooled after a checkpoint, for example the rows of a form which failed halfway
+        """
+        for sheet_name in list(self.spools.keys()):
+            if sheet_name in checkpoint:
+                self.spools[sheet_name].seek(checkpoint[sheet_name])
+                self.spools[sheet_name].truncate()
+            else:
+                self.spools.pop(sheet_name).close()
+
+    def iter_spooled_rows(self, sheet_name):
+        spool = self.spools[sheet_name]
+        spool.seek(0)
+        for line in spool:
+            yield json.loads(line)
+
+    def save_spooled_workbook(self, structure, sheet_attr_names):
+        """
+        Write the spooled rows to the workbook, one sheet at a time
+
+        Args:
+            structure (dict): The columns of each sheet
+            sheet_attr_names (list): The submission attributes shown at the begining of each sheet
+
+        """
+        self.open_workbook()
+        self.sheet_attr_names = sheet_attr_names
+        for sheet_name, sheet_fields in six.iteritems(structure):
+            self.sorted_sheet_fields[sheet_name] = self.order_fields(sheet_fields, sheet_attr_names)
+
+        # the main sheet is written even when it has no rows
+        sheet_names = ['main'] + [sheet_name for sheet_name in self.spools if sheet_name != 'main']
+        try:
+            try:
+                if self.format == 'xlsx':
+                    # the names of the sheets are reserved, so that the parts of a long sheet don't take the name of a later sheet
+                    self.worksheet_names = set(self.worksheet_name(sheet_name).lower() for sheet_name in sheet_names if sheet_name in self.sorted_sheet_fields)
+                for sheet_name in sheet_names:
+                    if sheet_name not in self.sorted_sheet_fields:
+                        continue
+                    terminal.tprint('Processing ' + sheet_name, 'okblue')
+                    self.write_spooled_sheet(sheet_name)
+            finally:
+                self.close_spools()
 
+            self.save_workbook()
+        finally:
+            if self.format == 'parquet':
+                # the parquet files are in the zip, or the export failed
+                shutil.rmtree(self.parquet_dir, ignore_errors=True)
 
+    def write_spooled_sheet(self, sheet_name):
+        while True:
+            try:
+                self.write_sheet(sheet_name, self.iter_spooled_records(sheet_name, self.sorted_sheet_fields[sheet_name]))
+                return
+            except IntegerOverflowError as e:
+                # the schema of a parquet file is fixed once it is created, so the sheet is written again from its spool
+                # with the column saved as text, which keeps the values as they are
+                terminal.tprint("\t%s. Saving %s.%s as text" % (str(e), sheet_name, e.field), 'warn')
+                self.column_types[e.field] = None
 
+    def iter_spooled_records(self, sheet_name, fields):
+        # the header and the spooled rows of a sheet, as lists of values in the order of the fields
+        yield fields
+        if sheet_name in self.spools:
+            for row in self.iter_spooled_rows(sheet_name):
+                yield [row.get(field, '-') for field in fields]
 
+    def close_spools(self):
+        for spool in self.spools.values():
+            spool.close()
+        self.spools = {}
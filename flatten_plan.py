@@ -0,0 +1,73 @@
+import re
+import threading
+
+from collections import OrderedDict
+
+from .type_classifier import TypeClassifier
+from .common_tasks import clean_json_key
+
+
+class FlattenPlan():
+    """
+    The compiled rules for flattening the submissions of a form
+
+    Every raw key of the submissions is compiled once into a (clean key, cleaner, answer type) entry, so that
+    flattening a submission is a lookup per key instead of cleaning the key with a regex, looking up the data cleaners
+    and classifying the value from scratch. The plans are cached per form, form structure and data cleaners, so they
+    are reused by the later exports of the same form version
+    """
+    _plans = OrderedDict()
+    _plans_lock = threading.Lock()
+    max_plans = 32
+
+    def __init__(self, type_classifier=None, cleaners=None):
+        """
+        Args:
+            type_classifier (TypeClassifier, optional): The classifier set up with the form structure
+            cleaners (dict, optional): The data cleaners, with the find regex and the replacer of each clean key
+        """
+        self.type_classifier = type_classifier if type_classifier is not None else TypeClassifier()
+        self.cleaners = {}
+        if cleaners:
+            for c_key, cleaner in cleaners.items():
+                self.cleaners[c_key] = (re.compile(cleaner['find']), cleaner['replacer'])
+        self.entries = {}
+
+    @classmethod
+    def get_plan(cls, plan_key, create_plan):
+        """
+        Get a cached plan, creating it if it is not cached
+
+        Args:
+            plan_key (tuple): Identifies the form version and the cleaners the plan is created for
+            create_plan (function): Creates the plan if it is not cached
+        """
+        with cls._plans_lock:
+            if plan_key in cls._plans:
+                cls._plans.move_to_end(plan_key)
+                return cls._plans[plan_key]
+
+        plan = create_plan()
+        with cls._plans_lock:
+            cls._plans[plan_key] = plan
+            while len(cls._plans) > cls.max_plans:
+                cls._plans.popitem(last=False)
+
+        return plan
+
+    def get_entry(self, raw_key):
+        # get the (clean key, cleaner, answer type) of a raw key, compiling it on first use
+        entry = self.entries.get(raw_key)
+        if entry is None:
+            clean_key = clean_json_key(raw_key)
+            entry = (clean_key, self.cleaners.get(clean_key), self.type_classifier.question_types.get(clean_key))
+            self.entries[raw_key] = entry
+
+        return entry
+
+    def classify(self, value, answer_type):
+        return self.type_classifier.classify_as(value, answer_type)
+
+    def clean_value(self, cleaner, value):
+        find, replacer = cleaner
+        return find.sub(replacer, value)
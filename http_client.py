@@ -0,0 +1,159 @@
+import itertools
+import threading
+import requests
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+
+
+class HttpClient():
+    """
+    A thin wrapper around a process-wide pooled HTTP session, shared by all the ODK server clients
+
+    The session keeps alive connections to each host (one bounded connection pool per host) so that sync jobs making
+    thousands of requests do not pay a TCP+TLS handshake per request. All requests get connect/read timeouts.
+
+    Settings (all optional):
+        HTTP_CONNECT_TIMEOUT: Seconds to wait for a connection to be established. Defaults to 10
+        HTTP_READ_TIMEOUT: Seconds to wait for the server to send data. Defaults to 300
+        HTTP_POOL_CONNECTIONS: The number of per-host connection pools to keep. Defaults to 10
+        HTTP_POOL_MAXSIZE: The maximum number of connections kept alive per host. Defaults to 10
+        HTTP_MAX_RETRIES: The number of retries on failed connections. Defaults to 2
+    """
+    _session = None
+    _session_lock = threading.Lock()
+
+    def __init__(self, headers=None, auth=None):
+        self.headers = headers if headers is not None else {}
+        self.auth = auth
+        self.timeout = (getattr(settings, 'HTTP_CONNECT_TIMEOUT', 10), getattr(settings, 'HTTP_READ_TIMEOUT', 300))
+
+    @classmethod
+    def get_session(cls):
+        # create the shared session on first use
+        if cls._session is None:
+            with cls._session_lock:
+                if cls._session is None:
+                    cls._session = cls.create_session()
+
+        return cls._session
+
+    @classmethod
+    def create_session(cls):
+        session = requests.Session()
+
+        # block all cookies since the session is shared between clients with different credentials
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        session.headers.update({'Accept-Encoding': 'gzip, deflate', 'Connection': 'keep-alive'})
+
+        # the pool doesn't block when all its connections are in use, requests wait for a connection without a timeout.
+        # The extra connections are discarded after use, the concurrent requests are capped by ConcurrentFetcher
+        adapter = HTTPAdapter(
+            pool_connections=getattr(settings, 'HTTP_POOL_CONNECTIONS', 10),
+            pool_maxsize=getattr(settings, 'HTTP_POOL_MAXSIZE', 10),
+            max_retries=getattr(settings, 'HTTP_MAX_RETRIES', 2),
+            pool_block=False
+        )
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+        return session
+
+    def request(self, method, url, **kwargs):
+        """
+        Execute a request using the shared session, adding the client headers, auth and the default timeouts
+        """
+        headers = dict(self.headers)
+        if 'headers' in kwargs:
+            headers.update(kwargs.pop('headers'))
+
+        if self.auth is not None:
+            kwargs.setdefault('auth', self.auth)
+        kwargs.setdefault('timeout', self.timeout)
+
+        return self.get_session().request(method, url, headers=headers, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return self.request('POST', url, data=data, **kwargs)
+
+    def put(self, url, data=None, **kwargs):
+        return self.request('PUT', url, data=data, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+
+class ConcurrentFetcher():
+    """
+    Fetches a list of urls using a bounded pool of worker threads and hands the results back to the calling thread
+
+    Only the HTTP requests run in the worker threads. The results are yielded in the calling thread as they complete,
+    so that a single writer saves them to the database. Besides the number of workers of each fetcher, the number of
+    in-flight requests to a server is capped across all the fetchers in the process.
+
+    Settings (all optional):
+        ODK_FETCH_WORKERS: The number of concurrent requests per fetcher. Defaults to 1, fetching serially
+        ODK_MAX_REQUESTS_PER_SERVER: The maximum number of in-flight requests per server. Defaults to HTTP_POOL_MAXSIZE
+    """
+    _server_slots = {}
+    _server_slots_lock = threading.Lock()
+
+    def __init__(self, fetch, workers=None):
+        """
+        Args:
+            fetch (function): A function that given a url fetches and returns its response
+            workers (int, optional): The number of concurrent requests. Defaults to ODK_FETCH_WORKERS
+        """
+        self.fetch = fetch
+        self.workers = workers if workers is not None else getattr(settings, 'ODK_FETCH_WORKERS', 1)
+
+    @classmethod
+    def is_enabled(cls):
+        return getattr(settings, 'ODK_FETCH_WORKERS', 1) > 1
+
+    @classmethod
+    def get_server_slots(cls, url):
+        host = urlparse(url).netloc
+        with cls._server_slots_lock:
+            if host not in cls._server_slots:
+                max_requests = getattr(settings, 'ODK_MAX_REQUESTS_PER_SERVER', getattr(settings, 'HTTP_POOL_MAXSIZE', 10))
+                cls._server_slots[host] = threading.BoundedSemaphore(max_requests)
+
+        return cls._server_slots[host]
+
+    def fetch_url(self, url):
+        with self.get_server_slots(url):
+            return self.fetch(url)
+
+    def fetch_all(self, urls):
+        """
+        Fetch all the urls, yielding (url, response) tuples in the order that the requests complete
+
+        At most `workers` requests are in flight at any time and the urls are consumed lazily
+        """
+        urls = iter(urls)
+        if self.workers <= 1:
+            for url in urls:
+                yield url, self.fetch_url(url)
+            return
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = {}
+            for url in itertools.islice(urls, self.workers):
+                pending[executor.submit(self.fetch_url, url)] = url
+
+            while len(pending) != 0:
+                done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    url = pending.pop(future)
+                    # top up the in-flight requests before handing over the result
+                    for next_url in itertools.islice(urls, 1):
+                        pending[executor.submit(self.fetch_url, next_url)] = next_url
+
+                    yield url, future.result()
@@ -0,0 +1,23 @@
+# Generated by Django 4.1.1 on 2026-10-16 08:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("vendor", "0015_alter_rawsubmissions_duration"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="odkform",
+            name="last_synced_time",
+            field=models.CharField(blank=True, max_length=100, null=True),
+        ),
+        migrations.AddField(
+            model_name="odkform",
+            name="last_synced_id",
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
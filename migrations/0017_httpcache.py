@@ -0,0 +1,30 @@
+# Generated by Django 4.1.1 on 2026-10-16 09:40
+
+from django.db import migrations, models
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("vendor", "0016_odkform_last_synced_time_odkform_last_synced_id"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="HttpCache",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("date_created", models.DateTimeField(auto_now=True)),
+                ("date_modified", models.DateTimeField(auto_now=True)),
+                ("url_hash", models.CharField(db_index=True, max_length=64, unique=True)),
+                ("url", models.CharField(max_length=2000)),
+                ("etag", models.CharField(blank=True, max_length=200, null=True)),
+                ("last_modified", models.CharField(blank=True, max_length=100, null=True)),
+                ("content", jsonfield.fields.JSONField()),
+            ],
+            options={
+                "db_table": "http_cache",
+            },
+        ),
+    ]
@@ -1,6 +1,6 @@
 from django.contrib.auth.models import User
 from django.db import models
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from django.core.validators import RegexValidator, MaxLengthValidator, MinLengthValidator
 from django.contrib.auth import get_user_model
@@ -117,6 +117,9 @@ class ODKForm(BaseTable):
     is_active = models.BooleanField(default=0)
     datetime_published = models.DateTimeField(default=None)
     latest_upload = models.DateTimeField(default=None, null=True, blank=True)
+    # the submission time and id of the latest submission saved from the server. Syncs only ask for newer submissions
+    last_synced_time = models.CharField(max_length=100, null=True, blank=True)
+    last_synced_id = models.PositiveIntegerField(null=True, blank=True)
 
     class Meta:
         db_table = 'odkform'
@@ -131,6 +134,15 @@ class ODKForm(BaseTable):
     def get_id(self):
         return self.id
 
+    def update_sync_watermark(self, last_synced_time, last_synced_id=None):
+        # the watermark only moves forward
+        if last_synced_time is None: return
+        if self.last_synced_time is not None and last_synced_time <= self.last_synced_time: return
+
+        self.last_synced_time = last_synced_time
+        self.last_synced_id = last_synced_id
+        self.save(update_fields=['last_synced_time', 'last_synced_id'])
+
 
 class RawSubmissions(BaseTable):
     # Define the structure of the submission table
@@ -315,6 +327,24 @@ class ProcessingErrors(BaseTable):
         return self.t_key
 
 
+class HttpCache(BaseTable):
+    # the last responses of the ODK server endpoints with their validators, used to make conditional requests
+    url_hash = models.CharField(max_length=64, unique=True, db_index=True)
+    url = models.CharField(max_length=2000)
+    etag = models.CharField(max_length=200, null=True, blank=True)
+    last_modified = models.CharField(max_length=100, null=True, blank=True)
+    content = JSONField()
+
+    class Meta:
+        db_table = 'http_cache'
+
+    def publish(self):
+        self.save()
+
+    def get_id(self):
+        return self.id
+
+
 # putting this last to avoid circular dependacies
 class Profile(models.Model):
     """
@@ -359,4 +389,17 @@ class Profile(models.Model):
 def create_or_update_user_profile(sender, instance, created, **kwargs):
     if created:
         Profile.objects.create(user=instance)
-    # instance.profile.save()
\ No newline at end of file
+    # instance.profile.save()
+
+
+@receiver([post_save, post_delete], sender=SystemSettings)
+def invalidate_settings_cache(sender, instance, **kwargs):
+    # imported here since the caches import the models
+    from .caches import SettingsCache, invalidate_on_commit
+    invalidate_on_commit(SettingsCache)
+
+
+@receiver([post_save, post_delete], sender=DictionaryItems)
+def invalidate_dictionary_cache(sender, instance, **kwargs):
+    from .caches import DictionaryCache, invalidate_on_commit
+    invalidate_on_commit(DictionaryCache)
@@ -733,8 +733,11 @@ class Notification():
 
                         # get the users in this campaign
                         user_groups = campaign.recipients.split(',')
-                        recipients = Recipients.objects.filter(designation__in=user_groups)
+                        recipients = Recipients.objects.filter(designation__in=user_groups).select_related('sub_county')
                         sub_counties_stats = {}
+                        if template.template_name == 'SCVO Weekly Report':
+                            # get the names of all the recipients' sub counties at once
+                            sub_county_names = odk_form.get_values_from_dictionary(list(set(recipient.sub_county.nick_name for recipient in recipients)))
                         for recipient in recipients:
                             if template.template_name == 'SCVO Weekly Reminder':
                                 # recipient_name
@@ -742,7 +745,7 @@ class Notification():
                             elif template.template_name == 'SCVO Weekly Report':
                                 if recipient.sub_county.nick_name not in sub_counties_stats:
                                     sc_stats = self.management_weekly_report(odk_form, [recipient.sub_county.nick_name, ''])
-                                    sub_county_name = str(odk_form.get_value_from_dictionary(recipient.sub_county.nick_name))
+                                    sub_county_name = str(sub_county_names[recipient.sub_county.nick_name])
                                     sub_counties_stats[recipient.sub_county.nick_name] = {'stats': sc_stats, 'sub_county_name': sub_county_name}
                                 else:
                                     sc_stats = sub_counties_stats[recipient.sub_county.nick_name]['stats']
@@ -1,20 +1,48 @@
-import requests
 import re
 import os
 import json
 import xmltodict
 import six
+import time
+import threading
+import decimal
 
+from datetime import datetime, timedelta, timezone
+from urllib.parse import quote
 from django.conf import settings
-from django.db import transaction
+from django.db import connection, transaction
+from concurrent.futures import ThreadPoolExecutor
 
 from .models import ODKFormGroup, ODKForm, RawSubmissions, DictionaryItems
+from .http_client import HttpClient, ConcurrentFetcher
+from .caches import DictionaryCache, invalidate_on_commit
+from .common_tasks import clean_json_key
 
 from .terminal_output import Terminal
 terminal = Terminal()
 
+# one client per server and user in each thread. The clients keep the state of the form being processed, so they are
+# not shared between threads. The connection pool and the session tokens are shared by all the clients
+central_clients = threading.local()
+
+
+def get_central_client(server_url, app_username, app_password):
+    """
+    Get the OdkCentral client of the current thread for the server and user, creating it on first use
+    """
+    if not hasattr(central_clients, 'clients'):
+        central_clients.clients = {}
+
+    client_key = (server_url, app_username, app_password)
+    if client_key not in central_clients.clients:
+        central_clients.clients[client_key] = OdkCentral(server_url, app_username, app_password)
+
+    return central_clients.clients[client_key]
+
+
 class OdkCentral():
     # lets define the endpoints for ODK central
+    create_session = '%(url)s/v1/sessions'
     cur_user_details = '%(url)s/v1/users/current'
     list_all_projects = '%(url)s/v1/projects'
     list_all_project_forms = '%(url)s/v1/projects/%(project_id)d/forms'
@@ -22,6 +50,8 @@ class OdkCentral():
     fetch_single_xml_submission = '%(url)s/v1/projects/%(project_id)d/forms/%(form_name)s/submissions/%(uuid)s.xml'
     fetch_json_submissions = '%(url)s/v1/projects/%(project_id)d/forms/%(form_name)s.svc/table?$wkt=true'
     submission_count = '%(url)s/v1/projects/%(project_id)d/forms/%(form_name)s.svc/Submissions?$top=0&$count=true'
+    fetch_odata_submissions = '%(url)s/v1/projects/%(project_id)d/forms/%(form_name)s.svc/Submissions?$expand=*&$orderby=__system/submissionDate%%20asc&$top=%(top)d&$skip=%(skip)d'
+    list_new_submissions = '%(url)s/v1/projects/%(project_id)d/forms/%(form_name)s.svc/Submissions?$filter=%(filter)s&$orderby=__system/submissionDate%%20asc&$top=%(top)d&$skip=%(skip)d'
     form_structure = '%(url)s/v1/projects/%(project_id)d/forms/%(form_id)s.xml'
 
     # xform important node attrs
@@ -35,36 +65,93 @@ class OdkCentral():
     ignore_attrs = ['class', 'appearance']
     ignored_qtypes = ['calculate', 'binary']
 
+    # the bearer tokens of the active sessions, keyed by the server and the user
+    _sessions = {}
+    _sessions_lock = threading.Lock()
+
     def __init__(self, server_url, app_username, app_password):
         self.server_url = server_url
         self.app_username = app_username
         self.app_password = app_password
         self.level_count = None
+        self.user_details = None
+        self.http_client = HttpClient()
 
-        # try and validate the credentials
-        try:
+    @property
+    def odk_user_id(self):
+        return self.get_user_details()['id']
+
+    @property
+    def odk_user_email(self):
+        return self.get_user_details()['email']
+
+    @property
+    def odk_user_name(self):
+        return self.get_user_details()['displayName']
+
+    def get_user_details(self):
+        # the user details are only fetched when needed. The credentials are validated when creating the session
+        if self.user_details is None:
             url = self.cur_user_details % {'url': self.server_url}
             response = self.process_curl_request(url)
-            user_data = response.json()
+            self.user_details = response.json()
 
-        except Exception as e:
-            raise
+        return self.user_details
 
-        self.odk_user_id = user_data['id']
-        self.odk_user_email = user_data['email']
-        self.odk_user_name = user_data['displayName']
+    def get_session_token(self, refresh=False):
+        """
+        Get a bearer token for the current user, creating a new session on the server if needed
+
+        The tokens are shared by all the clients in the process until they are about to expire, so that the
+        server doesn't have to check the password on every request
+
+        Args:
+            refresh (bool, optional): Whether to discard the cached token, for example when the server rejected it
+
+        Returns:
+            string: The bearer token
+        """
+        session_key = (self.server_url, self.app_username)
+        with OdkCentral._sessions_lock:
+            session_ = OdkCentral._sessions.get(session_key)
+            if session_ is not None and not refresh:
+                token, expires_at = session_
+                if expires_at > datetime.now(timezone.utc) + timedelta(seconds=getattr(settings, 'ODK_CENTRAL_TOKEN_MARGIN', 300)):
+                    return token
+
+            url = self.create_session % {'url': self.server_url}
+            terminal.tprint('\tCreating a new session for %s ....' % self.app_username, 'debug')
+            r = self.http_client.post(url, json={'email': self.app_username, 'password': self.app_password})
+            if r.status_code == 401:
+                raise Exception("Invalid username or password")
+            elif r.status_code != 200:
+                raise Exception("Error while creating a session on the ODK Central server. Response %d" % r.status_code)
+
+            session_data = r.json()
+            expires_at = datetime.fromisoformat(session_data['expiresAt'].replace('Z', '+00:00'))
+            OdkCentral._sessions[session_key] = (session_data['token'], expires_at)
+
+            return session_data['token']
 
     def process_curl_request(self, url, stream_data=False, req_type = 'GET'):
         """
         Create and execute a curl request
         """ 
         try:
-            if req_type == 'GET':
-                r = requests.get(url, auth=(self.app_username, self.app_password), stream=stream_data)
-            elif req_type == 'POST':
-                r = requests.post(url, auth=(self.app_username, self.app_password), stream=stream_data)
-            else:
-                raise Exception('Unsupported request type')
+            refresh_token = False
+            for attempt in range(2):
+                headers = {'Authorization': 'Bearer %s' % self.get_session_token(refresh_token)}
+                if req_type == 'GET':
+                    r = self.http_client.get(url, stream=stream_data, headers=headers)
+                elif req_type == 'POST':
+                    r = self.http_client.post(url, stream=stream_data, headers=headers)
+                else:
+                    raise Exception('Unsupported request type')
+
+                # the session might have been revoked on the server, so get a new token and try again
+                if r.status_code != 401: break
+                r.close()
+                refresh_token = True
 
             terminal.tprint('\tExecuting %s ....' % url, 'debug')
             
@@ -72,17 +159,21 @@ class OdkCentral():
                 # return r.iter_content(chunk_size=None, decode_unicode=True)
                 return r
 
+            # the body of a failed streamed response is not read, so close it to return the connection to the pool
             elif r.status_code == 401:
+                r.close()
                 raise Exception("Invalid username or password")
 
             elif r.status_code == 404:
                 terminal.tprint("\t%d: Form not found" % r.status_code, 'fail')
+                r.close()
                 return None
             else:
                 if settings.DEBUG:
                     terminal.tprint("\tResponse %d" % r.status_code, 'fail')
                     terminal.tprint(r.text, 'fail')
                     terminal.tprint(url, 'warn')
+                r.close()
                 return None
 
         except ConnectionError as e:
@@ -93,75 +184,413 @@ class OdkCentral():
             raise
 
     def process_user_projects(self):
-        # get all projects that the current user is authorized
+        """
+        Sync all the forms of all the projects that the current user is authorized
+
+        The projects and their forms are processed concurrently by ODK_SYNC_WORKERS threads (defaults to 1, serially).
+        All the threads share the connection pool, which keeps up to HTTP_POOL_MAXSIZE connections to the server alive
+
+        Returns:
+            list: The sync summary of each form, as returned by sync_form
+        """
         url = self.list_all_projects % {'url': self.server_url}
         response = self.process_curl_request(url)
         projects = response.json()
 
+        project_groups = []
         for proj in projects:
-            # process this project
             if settings.DEBUG: terminal.tprint('\tProcessing %s' % proj['name'], 'debug')
-            self.save_project(proj['name'], proj['id'])
-            self.process_user_project(proj['id'])
+            project_groups.append((proj['id'], self.save_project(proj['name'], proj['id'])))
+
+        all_forms = []
+        for project_forms in self.run_sync_jobs(self.list_project_forms, project_groups):
+            all_forms.extend(project_forms)
+
+        sync_results = self.run_sync_jobs(self.sync_form, all_forms)
+        self.print_sync_summary(sync_results)
+
+        return sync_results
 
-    def process_user_project(self, project_id):
+    def process_user_project(self, project_id, odk_group):
+        # sync all the forms of a single project
+        return self.run_sync_jobs(self.sync_form, self.list_project_forms(project_id, odk_group))
+
+    def list_project_forms(self, project_id, odk_group):
+        # get the open forms of a project as (project_id, form details, form group) tuples ready for sync_form
         url = self.list_all_project_forms % {'url': self.server_url, 'project_id': project_id}
         response = self.process_curl_request(url)
         all_forms = response.json()
 
-        for form in all_forms:
-            # process this form
-            # skip closed forms
-            if form['state'] != 'open' or form['draftToken']: continue
+        # skip closed forms
+        return [(project_id, form, odk_group) for form in all_forms if form['state'] == 'open' and not form['draftToken']]
+
+    def sync_form(self, project_id, form_details, odk_group):
+        """
+        Save a form and download its new submissions, catching any error so that it doesn't stop the other forms
+
+        Returns:
+            dict: The sync summary of the form with the number of new, skipped and failed submissions, the error if any
+                  and the time taken in seconds
+        """
+        start_time = time.time()
+        sync_result = {'project_id': project_id, 'form': form_details['xmlFormId'], 'new': 0, 'skipped': 0, 'failed': 0, 'error': None}
+        try:
             # first get the number of submissions
-            url = self.submission_count % {'url': self.server_url, 'project_id': project_id, 'form_name': form['xmlFormId']}
-            response = self.process_curl_request(url)
-            subm_count = response.json()['@odata.count']
+            subm_count = self.get_submissions_count(project_id, form_details['xmlFormId'])
 
-            self.save_form(project_id, form, subm_count)
-            self.process_form(project_id, form['xmlFormId'])
+            odk_form = self.save_form(project_id, form_details, subm_count, odk_group)
+            sync_result.update(self.process_form(project_id, form_details['xmlFormId'], odk_form, subm_count))
 
-    def process_form(self, project_id, form_name):
-        # check if the current form is saved
+        except Exception as e:
+            terminal.tprint("\tError while syncing the form '%s': %s" % (form_details['xmlFormId'], str(e)), 'fail')
+            sync_result['error'] = str(e)
+
+        sync_result['elapsed'] = round(time.time() - start_time, 2)
+        return sync_result
 
+    def run_sync_jobs(self, sync_job, all_args):
+        """
+        Run a sync job for each of the arguments, concurrently if ODK_SYNC_WORKERS is more than 1
+
+        Returns:
+            list: The results of the jobs, in the order of the arguments
+        """
+        workers = getattr(settings, 'ODK_SYNC_WORKERS', 1)
+        if workers <= 1:
+            return [sync_job(*args) for args in all_args]
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(lambda args: self.run_threaded_sync_job(sync_job, args), all_args))
+
+    def run_threaded_sync_job(self, sync_job, args):
+        try:
+            return sync_job(*args)
+        finally:
+            # each thread gets its own database connection, so close it before the thread is reused
+            connection.close()
+
+    def print_sync_summary(self, sync_results):
+        for sync_result in sync_results:
+            if sync_result['error'] is not None:
+                terminal.tprint("\t%s: Failed after %.2fs. %s" % (sync_result['form'], sync_result['elapsed'], sync_result['error']), 'fail')
+            else:
+                terminal.tprint("\t%s: %d new, %d skipped, %d failed in %.2fs" % (sync_result['form'], sync_result['new'], sync_result['skipped'], sync_result['failed'], sync_result['elapsed']), 'okblue')
+
+    def process_form(self, project_id, form_name, odk_form, subm_count=None):
+        """
+        Download and save the new submissions of a form
+
+        Args:
+            project_id (int): The ODK Central project id
+            form_name (string): The xmlFormId of the form
+            odk_form (ODKForm): The local form that the submissions belong to
+            subm_count (int, optional): The number of submissions on the server. It is fetched if not given
+
+        Returns:
+            dict: The number of new, skipped (already saved) and failed submissions
+        """
         # get number of submissions of this form
-        subm_count = self.get_submissions_count(project_id, form_name)
+        if subm_count is None:
+            subm_count = self.get_submissions_count(project_id, form_name)
 
         terminal.tprint('\tThe form %s has %d submissions' % (form_name, subm_count), 'debug')
 
-        # get all submissions
-        subm_url = self.list_all_form_submissions % {'url': self.server_url, 'project_id': project_id, 'form_name': form_name}
-        response = self.process_curl_request(subm_url)
-        subms_meta = response.json()
+        # load the uuids of the saved submissions once and diff them against the server listing in memory
+        watermark = odk_form.last_synced_time
+        known_uuids = RawSubmissions.objects.filter(form=odk_form)
+        if watermark is not None:
+            known_uuids = known_uuids.filter(submission_time__gte=watermark)
+        known_uuids = set(known_uuids.values_list('uuid', flat=True))
+
+        if getattr(settings, 'ODK_CENTRAL_XML_SUBMISSIONS', False):
+            return self.download_xml_submissions(project_id, form_name, odk_form, known_uuids, watermark)
+
+        expected_count = subm_count if watermark is None else subm_count - RawSubmissions.objects.filter(form=odk_form).count()
+        return self.download_odata_submissions(project_id, form_name, odk_form, known_uuids, watermark, expected_count)
 
+    def download_odata_submissions(self, project_id, form_name, odk_form, known_uuids, watermark=None, expected_count=None):
+        """
+        Download the submissions of a form as JSON from the paged OData submissions feed and save each page in one batch
+
+        The repeats are expanded inline, so a form with N submissions needs N/ODK_CENTRAL_PAGE_SIZE requests. If
+        ODK_FETCH_WORKERS is more than 1 and the number of submissions is known, the pages are fetched concurrently
+
+        Args:
+            project_id (int): The ODK Central project id
+            form_name (string): The xmlFormId of the form
+            odk_form (ODKForm): The local form that the submissions belong to
+            known_uuids (set): The uuids of the submissions of this form which are already saved
+            watermark (string, optional): If given, only the submissions received on or after this date are fetched
+            expected_count (int, optional): The number of submissions to fetch, used to plan the concurrent fetching
+
+        Returns:
+            dict: The number of new, skipped (already saved) and failed submissions. Failed pages are counted as one
+        """
+        page_size = getattr(settings, 'ODK_CENTRAL_PAGE_SIZE', 1000)
+
+        skip = 0
+        sync_result = {'new': 0, 'skipped': 0, 'failed': 0}
+        latest_submission = None
+        # the pages are sorted by submission date, oldest first, so that new submissions are added to the last page and
+        # the earlier pages don't shift while paging. Only move the watermark if all the pages were saved
+        page_failed = False
+        if ConcurrentFetcher.is_enabled() and expected_count:
+            page_urls = [self.odata_submissions_page_url(project_id, form_name, page_skip, page_size, watermark) for page_skip in range(0, expected_count, page_size)]
+            fetcher = ConcurrentFetcher(self.process_curl_request)
+            for url, response in fetcher.fetch_all(page_urls):
+                if response is None:
+                    page_failed = True
+                    sync_result['failed'] += 1
+                    continue
+                latest_submission = self.save_odata_page(odk_form, response.json(parse_float=decimal.Decimal)['value'], known_uuids, sync_result, latest_submission)
+
+            # continue serially in case more submissions came in after they were counted
+            skip = len(page_urls) * page_size
+
+        while True:
+            response = self.process_curl_request(self.odata_submissions_page_url(project_id, form_name, skip, page_size, watermark))
+            if response is None:
+                page_failed = True
+                sync_result['failed'] += 1
+                break
+
+            # keep the decimals as they were written, they are saved as strings like in the XML submissions
+            page = response.json(parse_float=decimal.Decimal)['value']
+            latest_submission = self.save_odata_page(odk_form, page, known_uuids, sync_result, latest_submission)
+            skip += len(page)
+            if settings.DEBUG: terminal.tprint("\tFetched %d submissions, %d new ones saved so far" % (skip, sync_result['new']), 'debug')
+
+            if len(page) < page_size:
+                # we have reached the last page
+                break
+
+        if not page_failed:
+            odk_form.update_sync_watermark(latest_submission)
+
+        return sync_result
+
+    def odata_submissions_page_url(self, project_id, form_name, skip, page_size, watermark=None):
+        url = self.fetch_odata_submissions % {'url': self.server_url, 'project_id': project_id, 'form_name': form_name, 'top': page_size, 'skip': skip}
+        if watermark is not None:
+            url = url + '&$filter=%s' % quote('__system/submissionDate ge %s' % watermark)
+
+        return url
+
+    def save_odata_page(self, odk_form, page, known_uuids, sync_result, latest_submission=None):
+        """
+        Save a page of OData submissions in one batch, skipping the submissions which are already saved
+
+        Args:
+            odk_form (ODKForm): The local form that the submissions belong to
+            page (list): The submissions as returned in the value of the OData submissions feed
+            known_uuids (set): The uuids of the saved submissions. It is updated with the newly saved uuids
+            sync_result (dict): The sync counts of the form, updated with the new and skipped submissions
+            latest_submission (string, optional): The latest submission date saved so far
+
+        Returns:
+            string: The latest submission date saved
+        """
+        new_submissions = []
+        for subm in page:
+            if subm['__id'] in known_uuids:
+                sync_result['skipped'] += 1
+                continue
+
+            submission_time = subm['__system']['submissionDate']
+            t_submission = RawSubmissions(
+                form=odk_form,
+                uuid=subm['__id'],
+                duration=0,
+                is_processed=0,
+                is_modified=0,
+                submission_time=submission_time,
+                raw_data=self.clean_odata_submission(subm)
+            )
+            t_submission.full_clean(validate_unique=False)
+            new_submissions.append(t_submission)
+            known_uuids.add(subm['__id'])
+            if latest_submission is None or submission_time > latest_submission:
+                latest_submission = submission_time
+
+        self.save_raw_submissions(new_submissions)
+        sync_result['new'] += len(new_submissions)
+        return latest_submission
+
+    def clean_odata_submission(self, node, is_root=True):
+        """
+        Remove the OData annotations and the server metadata from a submission so that only the form data is saved
+
+        The submission __id is kept on the root node, the ids linking the repeats to their parents are dropped. The
+        values are saved in the same form as the XML submissions: numbers as strings and the GeoJSON geo values as
+        the ODK "lat lon alt acc" strings, so that old and new submissions of a form can be exported together
+        """
+        if isinstance(node, list):
+            return [self.clean_odata_submission(item_, False) for item_ in node]
+
+        if isinstance(node, bool):
+            return 'true' if node else 'false'
+
+        if isinstance(node, (int, float, decimal.Decimal)):
+            return self.odk_number(node)
+
+        if not isinstance(node, dict):
+            return node
+
+        if node.get('type') in ('Point', 'LineString', 'Polygon') and 'coordinates' in node:
+            return self.odk_geo_value(node)
+
+        clean_node = {}
+        for key_, value_ in node.items():
+            if key_.startswith('@odata') or key_ == '__system': continue
+            if key_.startswith('__') and not (is_root and key_ == '__id'): continue
+
+            clean_node[key_] = self.clean_odata_submission(value_, False)
+
+        return clean_node
+
+    def odk_geo_value(self, geo_node):
+        """
+        Convert a GeoJSON value of the OData feed to the ODK geo string
+
+        A geopoint becomes "lat lon alt acc". The points of geotraces and geoshapes are joined with ";". GeoJSON has
+        the longitude first and keeps the accuracy of geopoints only, in the properties
+        """
+        def odk_point(coordinates, accuracy=None):
+            point = [coordinates[1], coordinates[0]] + list(coordinates[2:3])
+            if accuracy is not None:
+                # the accuracy is the fourth value, so a missing altitude is written as 0 like ODK Collect does
+                if len(point) == 2: point.append(0)
+                point.append(accuracy)
+            return ' '.join(self.odk_number(value_) for value_ in point)
+
+        if geo_node['type'] == 'Point':
+            properties = geo_node.get('properties') or {}
+            return odk_point(geo_node['coordinates'], properties.get('accuracy'))
+
+        points = geo_node['coordinates'][0] if geo_node['type'] == 'Polygon' else geo_node['coordinates']
+        return ';'.join(odk_point(point) for point in points)
+
+    def odk_number(self, value):
+        # write a number the way it appears in the XML submissions: as written, without an exponent. The floats are
+        # formatted from their shortest representation so that no binary rounding digits are added
+        if not isinstance(value, (float, decimal.Decimal)):
+            return str(value)
+        if isinstance(value, float):
+            value = decimal.Decimal(repr(value))
+        if not value.is_finite():
+            return str(value)
+        return format(value, 'f')
+
+    def download_xml_submissions(self, project_id, form_name, odk_form, known_uuids, watermark=None):
+        """
+        Download the submissions of a form one by one as XML. Used when ODK_CENTRAL_XML_SUBMISSIONS is set
+
+        Returns:
+            dict: The number of new, skipped (already saved) and failed submissions
+        """
+        if watermark is None:
+            # get all submissions
+            subm_url = self.list_all_form_submissions % {'url': self.server_url, 'project_id': project_id, 'form_name': form_name}
+            response = self.process_curl_request(subm_url)
+            subms_meta = response.json()
+        else:
+            # only get the submissions received since the last sync
+            subms_meta = self.list_submissions_since(project_id, form_name, watermark)
+
+        batch_size = getattr(settings, 'RAW_SUBMISSIONS_BATCH_SIZE', 500)
+        new_submissions = []
+        sync_result = {'new': 0, 'skipped': 0, 'failed': 0}
+        latest_submission = None
+
+        # the submissions to download, keyed by their xml url
+        pending_subms = {}
         for subm in subms_meta:
+            # skip if this submission is already saved
+            if subm['instanceId'] in known_uuids:
+                sync_result['skipped'] += 1
+                continue
+
             xml_url = self.fetch_single_xml_submission % {'url': self.server_url, 'project_id': project_id, 'form_name': form_name, 'uuid': subm['instanceId']}
-            response = self.process_curl_request(xml_url, True)
+            pending_subms[xml_url] = subm
+
+        # the downloads run concurrently if ODK_FETCH_WORKERS is set, but the submissions are saved from this thread
+        fetcher = ConcurrentFetcher(lambda url: self.process_curl_request(url, True))
+        for xml_url, response in fetcher.fetch_all(list(pending_subms.keys())):
+            subm = pending_subms[xml_url]
+            if response is None:
+                sync_result['failed'] += 1
+                continue
+
             raw_xml = response.content.decode('utf-8')
             # print(raw_xml)
             # terminal.tprint(json.dumps(xmltodict.parse(raw_xml, process_namespaces=True, namespaces={'http://opendatakit.org/submissions': None})), 'fail')    
 
-            try:
-                # skip if this submission is already saved
-                RawSubmissions.objects.get(uuid=subm['instanceId'])
-            except RawSubmissions.DoesNotExist:
-                t_submission = RawSubmissions(
-                    form=self.cur_form,
-                    # it seems some submissions don't have a uuid returned with the submission. Use our previous uuid
-                    uuid=subm['instanceId'],
-                    duration=0,
-                    is_processed=0,
-                    is_modified=0,
-                    submission_time=subm['createdAt'],
-                    raw_data=xmltodict.parse(raw_xml, process_namespaces=True, namespaces={'http://opendatakit.org/submissions': None})['data']
-                )
-                t_submission.full_clean()
-                t_submission.save()
-            # raise Exception('Testing')
+            t_submission = RawSubmissions(
+                form=odk_form,
+                # it seems some submissions don't have a uuid returned with the submission. Use our previous uuid
+                uuid=subm['instanceId'],
+                duration=0,
+                is_processed=0,
+                is_modified=0,
+                submission_time=subm['createdAt'],
+                raw_data=xmltodict.parse(raw_xml, process_namespaces=True, namespaces={'http://opendatakit.org/submissions': None})['data']
+            )
+            t_submission.full_clean(validate_unique=False)
+            new_submissions.append(t_submission)
+            sync_result['new'] += 1
+            known_uuids.add(subm['instanceId'])
+            if latest_submission is None or subm['createdAt'] > latest_submission:
+                latest_submission = subm['createdAt']
+
+            if len(new_submissions) >= batch_size:
+                self.save_raw_submissions(new_submissions)
+                new_submissions = []
+
+        self.save_raw_submissions(new_submissions)
+
+        # the submissions are not downloaded in order, so only move the watermark if all of them were saved
+        if sync_result['failed'] == 0:
+            odk_form.update_sync_watermark(latest_submission)
 
+        return sync_result
 
-        # terminal.tprint(json.dumps(all_forms), 'fail')
-        # raise Exception('Testing')
+    def list_submissions_since(self, project_id, form_name, watermark):
+        """
+        List the submissions of a form received on or after the watermark, using the OData submissions endpoint
+
+        Args:
+            project_id (int): The ODK Central project id
+            form_name (string): The xmlFormId of the form
+            watermark (string): The submission date of the latest submission saved
+
+        Returns:
+            list: The submissions as {'instanceId': ..., 'createdAt': ...} like the submissions listing
+        """
+        page_size = getattr(settings, 'ODK_CENTRAL_PAGE_SIZE', 1000)
+        subm_filter = quote('__system/submissionDate ge %s' % watermark)
+
+        subms_meta = []
+        while True:
+            url = self.list_new_submissions % {'url': self.server_url, 'project_id': project_id, 'form_name': form_name, 'filter': subm_filter, 'top': page_size, 'skip': len(subms_meta)}
+            response = self.process_curl_request(url)
+            if response is None:
+                # a partial listing would move the watermark past the missing submissions
+                raise Exception("Error while listing the new submissions of the form '%s'" % form_name)
+
+            page = response.json()['value']
+            for subm in page:
+                subms_meta.append({'instanceId': subm['__id'], 'createdAt': subm['__system']['submissionDate']})
+
+            if len(page) < page_size: break
+
+        return subms_meta
+
+    def save_raw_submissions(self, new_submissions):
+        # insert the new submissions in batches, skipping any that has been saved in the meantime
+        if len(new_submissions) == 0: return
+
+        with transaction.atomic():
+            RawSubmissions.objects.bulk_create(new_submissions, batch_size=getattr(settings, 'RAW_SUBMISSIONS_BATCH_SIZE', 500), ignore_conflicts=True)
 
     def save_project(self, project_name, project_id):
         # In ODK central we have a project, but in ona we didn't have. The project is roughly equal to
@@ -172,7 +601,7 @@ class OdkCentral():
         # In ODK central form_group have a 1:1 relationship with forms
 
         try:
-            self.cur_project = ODKFormGroup.objects.get(form_project=project_name)
+            return ODKFormGroup.objects.get(form_project=project_name)
 
         except ODKFormGroup.DoesNotExist:
             if settings.DEBUG: terminal.tprint("\tThe group/project '%s' doesn't exist. Creating a new group..." % project_name, 'debug')
@@ -184,11 +613,11 @@ class OdkCentral():
             new_group.full_clean()
             new_group.save()
 
-            self.cur_project = new_group
+            return new_group
 
-    def save_form(self, project_id, form_details, subm_count):
+    def save_form(self, project_id, form_details, subm_count, odk_group):
         try:
-            self.cur_form = ODKForm.objects.get(full_form_id=form_details['xmlFormId'])
+            return ODKForm.objects.get(full_form_id=form_details['xmlFormId'])
 
         except ODKForm.DoesNotExist:
             # the form does not exist, lets create a new form
@@ -196,7 +625,7 @@ class OdkCentral():
 
             new_form = ODKForm(
                 form_id=form_details['sha256'],
-                form_group=self.cur_project,
+                form_group=odk_group,
                 form_name=form_details['name'],
                 full_form_id=form_details['xmlFormId'],
                 no_submissions=subm_count,
@@ -206,7 +635,7 @@ class OdkCentral():
             new_form.full_clean()
             new_form.save()
 
-            self.cur_form = new_form
+            return new_form
 
     def get_submissions_count(self, project_id, form_name):
         url = self.submission_count % {'url': self.server_url, 'project_id': project_id, 'form_name': form_name}
@@ -235,6 +664,8 @@ class OdkCentral():
         cur_odk_form.processed_structure = form_struct
         cur_odk_form.save()
         transaction.commit()
+        # the dictionary was saved in manual transaction management, so invalidate the labels cached in the meantime
+        DictionaryCache.invalidate()
 
     def process_odk_central_form(self, raw_data):
         # get all the question types first and then add the other details
@@ -334,10 +765,12 @@ class OdkCentral():
 
     def clean_json_key(self, j_key):
         # given a key from ona with data, get the sane(last) part of the key
-        m = re.findall("/?([\.\w\-]+)$", j_key)
-        return m[0]
+        return clean_json_key(j_key)
 
     def save_form_dictionary(self, form_struct, form_id):
+        # collect the new dictionary items against the saved ones and save them in one go
+        saved_keys = set(DictionaryItems.objects.filter(form_group=form_id).values_list('parent_node', 't_key'))
+        dict_items = []
         not_defined = []
         for node_key, node_ in form_struct.items():
             if node_key == '_all_choices':
@@ -346,7 +779,7 @@ class OdkCentral():
                 continue
             elif 'label' not in node_:
                 not_defined.append(node_key)
-            else:
+            elif (None, node_key) not in saved_keys:
                 # print(node_['label'])
                 dict_item = DictionaryItems(
                     form_group=form_id,             # using formid in ODK central since forms are unique
@@ -356,12 +789,14 @@ class OdkCentral():
                     t_type=node_['type'],
                     t_value=node_['label']
                 )
-                dict_item.full_clean()
-                dict_item.save()
+                dict_item.full_clean(validate_unique=False)
+                dict_items.append(dict_item)
+                saved_keys.add((None, node_key))
 
 
         for key_, label_ in form_struct['_all_choices'].items():
             # print('\t%s -- %s' % (key_, label_))
+            if (None, key_) in saved_keys: continue
             dict_option = DictionaryItems(
                 form_group=form_id,             # using formid in ODK central since forms are unique
                 parent_node=None,               # for selects
@@ -370,8 +805,12 @@ class OdkCentral():
                 t_type='option',
                 t_value=label_
             )
-            dict_option.full_clean()
-            dict_option.save()
+            dict_option.full_clean(validate_unique=False)
+            dict_items.append(dict_option)
+            saved_keys.add((None, key_))
+
+        DictionaryItems.objects.bulk_create(dict_items, batch_size=500, ignore_conflicts=True)
+        invalidate_on_commit(DictionaryCache)
 
 
 
@@ -6,15 +6,17 @@ import collections
 import logging
 import traceback
 import json
-import copy
 import subprocess
 import hashlib
+import multiprocessing
+import tempfile
 
 import pandas as pd
 
 from datetime import datetime
 from collections import defaultdict, OrderedDict
 from contextlib import suppress
+from concurrent.futures import ProcessPoolExecutor
 from django.db import connections
 
 from raven import Client
@@ -25,16 +27,28 @@ from django.core.paginator import Paginator
 from django.core.exceptions import FieldDoesNotExist
 from requests.exceptions import ConnectionError
 from django.http import HttpRequest
+from django.utils import timezone
 
 from .terminal_output import Terminal
-from .common_tasks import ProgressBar
-from .excel_writer import ExcelWriter
+from .common_tasks import ProgressBar, clean_json_key
+from .excel_writer import ExcelWriter, split_sheet_rows
+from .http_client import HttpClient, ConcurrentFetcher
+from .caches import SettingsCache, DictionaryCache, invalidate_on_commit
+from .type_classifier import TypeClassifier
+from .flatten_plan import FlattenPlan
 if settings.SITE_NAME == 'Pazuri Records':
-    from .models import RawSubmissions, FormViews, ViewsData, ViewTablesLookup, DictionaryItems, FormMappings, ProcessingErrors, ODKFormGroup, SystemSettings
+    from .models import RawSubmissions, FormViews, ViewsData, ViewTablesLookup, DictionaryItems, FormMappings, ProcessingErrors, ODKFormGroup, SystemSettings, HttpCache
     from poultry.models import ODKForm
 else:
-    from .models import ODKForm, RawSubmissions, FormViews, ViewsData, ViewTablesLookup, DictionaryItems, FormMappings, ProcessingErrors, ODKFormGroup, SystemSettings
+    from .models import ODKForm, RawSubmissions, FormViews, ViewsData, ViewTablesLookup, DictionaryItems, FormMappings, ProcessingErrors, ODKFormGroup, SystemSettings, HttpCache
 import six
+import itertools
+
+# ijson is optional, it is used to parse large responses incrementally
+try:
+    import ijson
+except Exception:
+    ijson = None
 from six.moves import range
 from six.moves import zip
 
@@ -61,6 +75,54 @@ logging.basicConfig(format=FORMAT)
 logger.setLevel(logging.DEBUG)
 request = HttpRequest()
 
+# the parser running an export, inherited by the forked export workers
+export_parser = None
+# the database connections a worker inherited from the parent process
+inherited_connections = []
+
+
+def init_export_worker():
+    # the pooled http connections of the parent process can't be shared with the workers
+    HttpClient._session = None
+
+    # neither can the database connections, so the workers open their own. The inherited ones are kept referenced and
+    # never closed, closing them would close the connections of the parent process too
+    for conn in connections.all():
+        if conn.connection is not None:
+            inherited_connections.append(conn.connection)
+            conn.connection = None
+
+
+def flatten_form_in_worker(form_id, nodes, uuids, is_dry_run, submission_filters, base_structure):
+    # flatten the saved submissions of a form in a forked worker, starting with the output structure of a new export.
+    # The flattened submissions are spooled to a temporary file, a json line of [submission, add_cols_data] each, so
+    # neither the worker nor the parent holds the whole form in memory
+    parser = export_parser
+    parser.output_structure = dict((sheet_name, list(columns)) for sheet_name, columns in six.iteritems(base_structure))
+    parser.indexes = {'main': 1}
+    parser.sheet_columns = {}
+    parser.interest_nodes = None
+
+    if settings.ODK_SERVER == 'onadata':
+        form_id = int(form_id)
+    nodes = list(nodes) if nodes is not None else None
+
+    # the submissions are synced by the parent before forking
+    submissions_list = parser.get_all_submissions(form_id, uuids, False)
+    if submissions_list is None or submissions_list.count() == 0:
+        return None, parser.output_structure
+
+    spool = tempfile.NamedTemporaryFile(mode='w', encoding='utf-8', suffix='.jsonl', delete=False)
+    try:
+        with spool:
+            for pk_key, data, add_cols_data in parser.iter_flattened_submissions(form_id, submissions_list, nodes, is_dry_run, submission_filters):
+                spool.write(json.dumps([data, add_cols_data], default=str) + '\n')
+    except Exception:
+        os.unlink(spool.name)
+        raise
+
+    return spool.name, parser.output_structure
+
 
 class OdkParser():
     def __init__(self, ona_user=None, ona_password=None, ona_token=None, farm_id=None):
@@ -75,6 +137,18 @@ class OdkParser():
         self.form_stats = 'api/v1/stats/submissions/'
         self.form_rep = 'api/v1/forms/'
         self.media = 'api/v1/media'
+        self.http_client = HttpClient()
+
+        # the dictionary items found while extracting a form structure, saved in one go at the end
+        self.pending_dictionary_items = None
+
+        # the compiled rules for flattening the submissions, set up with the form structure when processing submissions
+        self.flatten_plan = FlattenPlan()
+        # sets of the output columns of each sheet and of the nodes of interest, for fast membership checks
+        self.sheet_columns = {}
+        self.interest_nodes = None
+        # the id of the main row of the submission being flattened
+        self.cur_top_id = None
 
         if not hasattr(settings, 'ODK_SERVER') or (hasattr(settings, 'ODK_SERVER') and settings.ODK_SERVER == 'onadata'):
             if ona_token is None:
@@ -102,10 +176,9 @@ class OdkParser():
 
     def load_ona_settings(self):
         # if the ona settings have been saved, load them here for later use
-        ona_settings = SystemSettings.objects.filter(setting_key__contains='ona_')
-
-        for setting in ona_settings:
-            setattr(self, setting.setting_key, setting.setting_value)
+        for setting_key, setting_value in SettingsCache.get_all().items():
+            if 'ona_' in setting_key:
+                setattr(self, setting_key, setting_value)
 
         try:
             print(self.ona_url)
@@ -117,9 +190,8 @@ class OdkParser():
         """
         Load the defined settings in the database to be system variables
         """
-        sys_settings = SystemSettings.objects.all()
-        for setting in sys_settings:
-            setattr(self, setting.setting_key, setting.setting_value)
+        for setting_key, setting_value in SettingsCache.get_all().items():
+            setattr(self, setting_key, setting_value)
 
     def load_mapped_connection(self):
         all_settings = self.get_all_settings()
@@ -145,7 +217,7 @@ class OdkParser():
         with suppress(AttributeError):
             if settings.IGNORE_ONA_DB_SETTINGS: return True
             
-        ona_settings = SystemSettings.objects.filter(setting_key__contains='ona_')
+        ona_settings = [setting_key for setting_key in SettingsCache.get_all() if 'ona_' in setting_key]
         return False if len(ona_settings) == 0 else True
 
     def get_all_forms(self):
@@ -168,19 +240,32 @@ class OdkParser():
         return to_return
 
     def get_value_from_dictionary(self, t_key):
+        return self.get_values_from_dictionary([t_key])[t_key]
+
+    def get_values_from_dictionary(self, t_keys):
+        """
+        Get the labels of many dictionary keys at once. The labels are cached, so only the new keys are queried
+
+        Args:
+            t_keys (list): The dictionary keys to get the labels for
+
+        Returns:
+            dict: The labels keyed by the dictionary keys. Keys which are not in the dictionary get 'Unknown (<key>)'
+        """
         try:
-            query = """
-                SELECT t_value from dictionary_items where t_key = '%s'
-            """ % t_key
-            with connection.cursor() as cursor:
-                cursor.execute(query)
-                t_value = cursor.fetchall()
-            return t_value[0][0]
+            t_values = DictionaryCache.get_values(t_keys)
         except Exception as e:
-            logging.error("Couldn't find the value for the key '%s' in the dictionary. %s" % (t_key, str(e)))
-            terminal.tprint("Couldn't find the value for the key '%s' in the dictionary. %s" % (t_key, str(e)), 'fail')
             sentry.captureException()
-            return "Unknown (%s)" % t_key
+            terminal.tprint("Couldn't get the values of the keys from the dictionary. %s" % str(e), 'fail')
+            t_values = {}
+
+        for t_key in t_keys:
+            if t_key not in t_values:
+                logging.error("Couldn't find the value for the key '%s' in the dictionary." % t_key)
+                terminal.tprint("Couldn't find the value for the key '%s' in the dictionary." % t_key, 'fail')
+                t_values[t_key] = "Unknown (%s)" % t_key
+
+        return t_values
 
     def refresh_forms(self, process_structure=False, auto_create_form_group=False):
         """
@@ -191,7 +276,7 @@ class OdkParser():
 
         try:
             url = "%s/%s" % (self.ona_url, self.api_all_forms)
-            all_forms = self.process_curl_request(url)
+            all_forms = self.process_cached_curl_request(url)
             # terminal.tprint(json.dumps(all_forms), 'fail')
             if all_forms is None:
                 if settings.DEBUG: print(("Error while executing the API request %s" % url))
@@ -210,6 +295,15 @@ class OdkParser():
             terminal.tprint(str(e), 'fail')
             raise Exception('There was an error while fetching new forms from the database...')
 
+        # load the saved forms and groups once and work out the changes in memory
+        saved_forms = {}
+        for saved_form in ODKForm.objects.all():
+            saved_forms[str(saved_form.form_id)] = saved_form
+        saved_groups = {} if not auto_create_form_group else dict((group.group_name, group) for group in ODKFormGroup.objects.all())
+
+        changed_forms = []
+        changed_fields = set()
+        new_forms = []
         for form in all_forms:
             if hasattr(settings, 'FORMS_OF_INTEREST'):
                 if form['id_string'] not in settings.FORMS_OF_INTEREST:
@@ -222,30 +316,39 @@ class OdkParser():
                 # else:
                 #     saved_form = ODKForm.objects.get(full_form_id=form['id_string'])
 
-                saved_form = ODKForm.objects.get(form_id=form['formid'])
+                if str(form['formid']) not in saved_forms:
+                    raise ODKForm.DoesNotExist()
+                saved_form = saved_forms[str(form['formid'])]
 
                 # if the form is not active and the number of saved submissions is equal to the online submissions, omit the form
                 is_fully_processed = True if form['downloadable'] == False and saved_form.no_submissions == form['num_of_submissions'] else False
                 
                 terminal.tprint("The form '%s' (%s) is already saved in the database" % (saved_form.form_name, form['downloadable']), 'ok')
+                form_changes = []
                 if saved_form.is_active != form['downloadable']:
                     saved_form.is_active = form['downloadable']
+                    form_changes.append('is_active')
 
                 if saved_form.no_submissions != form['num_of_submissions']:
                     saved_form.no_submissions = form['num_of_submissions']
-                    saved_form.latest_upload = form['last_updated_at']
+                    saved_form.latest_upload = datetime.strptime(form['last_updated_at'], '%Y-%m-%dT%H:%M:%S.%f%z')
                     saved_form.datetime_published = datetime.strptime(form['date_created'], '%Y-%m-%dT%H:%M:%S.%f%z')
-                
-                saved_form.save()
+                    form_changes.extend(['no_submissions', 'latest_upload', 'datetime_published'])
+
+                # only the forms which have changed are updated
+                if len(form_changes) != 0:
+                    saved_form.date_modified = timezone.now()
+                    changed_fields.update(form_changes + ['date_modified'])
+                    changed_forms.append(saved_form)
                 
                 if is_fully_processed == False:
                     to_return.append({'title': saved_form.form_name, 'id': saved_form.form_id, 'full_id': saved_form.full_form_id})
 
             except ODKForm.DoesNotExist as e:
-                # this form is not saved in the database, so save it
+                # this form is not saved in the database, so queue it for saving
                 terminal.tprint("The form '%s' is not in the database, saving it" % form['id_string'], 'debug')
                 if auto_create_form_group:
-                    form_group = self.auto_create_form_group(form['id_string'])
+                    form_group = self.auto_create_form_group(form['id_string'], saved_groups)
                     if form_group is None:
                         # we have been asked to create a group if it doesn't exist but encountered an error! I just cant go on, I refuse
                         raise Exception("There was an error while creating an automatic form group, which was needed!")
@@ -268,7 +371,6 @@ class OdkParser():
                     if settings.SITE_NAME == 'Pazuri Records':
                         cur_form.farm_id = self.cur_farm_id
 
-                    cur_form.publish()
                 except FieldDoesNotExist:
                     cur_form = ODKForm(
                         form_id=form['formid'],
@@ -278,26 +380,76 @@ class OdkParser():
                         auto_update=False,
                         is_source_deleted=False
                     )
-                    cur_form.publish()
                 except:
                     raise
 
-                if process_structure:
-                    # we to process and save the form structure
-                    # we need to have the cur_form_group set for this operation
-                    if form_group is None:
-                        raise Exception("Refusing to process the form structure for '%s' since the form group is not defined. This process will fail downstream." % form['id_string'])
+                new_forms.append((cur_form, form, form_group))
+            except Exception as e:
+                sentry.captureException()
+                terminal.tprint(str(e), 'fail')
+
+        self.save_refreshed_forms(changed_forms, changed_fields, new_forms)
+
+        for cur_form, form, form_group in new_forms:
+            if cur_form.pk is None:
+                # the form was not saved
+                continue
+
+            if process_structure:
+                # we to process and save the form structure
+                # we need to have the cur_form_group set for this operation
+                if form_group is None:
+                    sentry.captureMessage("Refusing to process the form structure for '%s' since the form group is not defined. This process will fail downstream." % form['id_string'], level='warning')
+                    terminal.tprint("Refusing to process the form structure for '%s' since the form group is not defined. This process will fail downstream." % form['id_string'], 'fail')
+                    continue
 
+                try:
                     self.cur_form_group = form_group.id
                     self.get_form_structure_from_server(form['formid'])
+                except Exception as e:
+                    sentry.captureException()
+                    terminal.tprint(str(e), 'fail')
+                    continue
 
-                to_return.append({'title': form['title'], 'id': form['formid'], 'full_id': form['id_string']})
-            except Exception as e:
-                sentry.captureException()
-                terminal.tprint(str(e), 'fail')
+            to_return.append({'title': form['title'], 'id': form['formid'], 'full_id': form['id_string']})
 
         return to_return
 
+    def save_refreshed_forms(self, changed_forms, changed_fields, new_forms):
+        """
+        Save the changes of a forms refresh in bulk
+
+        Args:
+            changed_forms (list): The saved forms which have changed
+            changed_fields (set): The names of the fields which have changed in any of the changed forms
+            new_forms (list): The new forms as (form, server form details, form group) tuples. The forms which cannot
+                              be saved are left without a primary key
+        """
+        if len(changed_forms) != 0:
+            ODKForm.objects.bulk_update(changed_forms, sorted(changed_fields), batch_size=500)
+
+        if len(new_forms) == 0:
+            return
+
+        try:
+            # the primary keys are needed later, so the forms are only created in bulk where the database returns them
+            with transaction.atomic():
+                if connection.features.can_return_rows_from_bulk_insert:
+                    ODKForm.objects.bulk_create([cur_form for cur_form, form, form_group in new_forms], batch_size=500)
+                else:
+                    for cur_form, form, form_group in new_forms:
+                        cur_form.publish()
+        except Exception:
+            # save what we can one form at a time
+            for cur_form, form, form_group in new_forms:
+                try:
+                    cur_form.pk = None
+                    cur_form.publish()
+                except Exception as e:
+                    cur_form.pk = None
+                    sentry.captureException()
+                    terminal.tprint(str(e), 'fail')
+
     def get_all_submissions(self, form_id, uuids=None, update_local_data=True):
         """
         Given a form id or the uuids, get all the submitted data
@@ -347,14 +499,29 @@ class OdkParser():
                 terminal.tprint("\tWe have some new submissions, so fetch them from the server and save them offline", 'info')
                 # fetch the submissions and filter by submission time
 
+                # only ask the server for the submissions received since the last sync
+                watermark = self.get_sync_watermark(odk_form)
 
-                if settings.ODK_SERVER == 'onadata':
+                # load the uuids of the saved submissions once and diff them against the server listing in memory
+                known_uuids = RawSubmissions.objects.filter(form_id=odk_form.id)
+                if watermark is not None:
+                    known_uuids = known_uuids.filter(submission_time__gte=watermark)
+                known_uuids = set(known_uuids.values_list('uuid', flat=True))
+
+                if settings.ODK_SERVER == 'onadata' and getattr(settings, 'ONA_BULK_DOWNLOAD', True):
+                    # page through the full submissions instead of fetching them one at a time
+                    expected_count = submitted_instances if watermark is None else submitted_instances - submissions.count()
+                    self.bulk_download_ona_submissions(odk_form, form_id, known_uuids, expected_count)
+                    submission_uuids = []
+                elif settings.ODK_SERVER == 'onadata':
                     if settings.IS_DRY_RUN == True:
                         url = "%s/%s%s.json?start=1&limit=5&sort=%s" % (self.ona_url, self.form_data, str(form_id), '{"_submission_time":-1}')
                     else:
                         url = "%s/%s%s.json?sort=%s" % (self.ona_url, self.form_data, str(form_id), '{"_submission_time":-1}')
-                    submission_uuids = self.process_curl_request(url)
-                    if submission_uuids is None: submission_uuids = []
+                    url = url + self.ona_watermark_query(watermark)
+                    # the listing has the full submissions, keep only what we need from each as it is parsed
+                    listing = self.process_curl_request_stream(url)
+                    submission_uuids = [] if listing is None else [{'_uuid': subm['_uuid'], '_id': subm['_id'], '_duration': subm.get('_duration')} for subm in listing]
                 elif settings.ODK_SERVER == 'odk_central':
                     # need to improve this section.....
                     # from .odk_central_parser import OdkCentral
@@ -365,6 +532,9 @@ class OdkParser():
                     submission_uuids = []
 
                 subm_count = 0
+                new_submissions = []
+                latest_submission = None
+                fetch_failed = False
                 if settings.DEBUG: progress_bar = ProgressBar()
                 for uuid in submission_uuids:
                     # obey the debug setting
@@ -374,34 +544,35 @@ class OdkParser():
                             if settings.DEBUG: terminal.tprint("\tWe have downloaded our maximum number of submissions under dry ran settings", 'info')
                             break
 
-                    # check if the current uuid is saved in the database
-                    # print odk_form.id
-                    # print uuid['_uuid']
-                    cur_submission = RawSubmissions.objects.filter(form_id=odk_form.id, uuid=uuid['_uuid'])
-                    if cur_submission.count() == 0:
-                        # the current submission is not saved in the database, so fetch and save it...
-                        url = "%s/%s%d/%s" % (self.ona_url, self.form_data, form_id, uuid['_id'])
-                        submission = self.process_curl_request(url)
-                        if not submission: continue     # we have an issue in fetching the data from the database
-                        # terminal.tprint(json.dumps(submission), 'warn')
-
-                        t_submission = RawSubmissions(
-                            form_id=odk_form.id,
-                            # it seems some submissions don't have a uuid returned with the submission. Use our previous uuid
-                            uuid=uuid['_uuid'],
-                            duration=0 if uuid['_duration'] == '' or uuid['_duration'] < 0 else uuid['_duration'],
-                            instance_id=uuid['_id'],
-                            submission_time=submission['_submission_time'],
-                            raw_data=submission
-                        )
-                        t_submission.publish()
-                    else:
-                        # the current submission is already saved, so stop the processing
-                        # terminal.tprint("The current submission is already saved, implying that all submissions have been processed, so stop the processing!", 'okblue')
+                    if uuid['_uuid'] in known_uuids:
+                        # the current submission is already saved, so skip it
+                        continue
+
+                    # the current submission is not saved in the database, so fetch and queue it for saving...
+                    url = "%s/%s%d/%s" % (self.ona_url, self.form_data, form_id, uuid['_id'])
+                    submission = self.process_curl_request(url)
+                    if not submission:
+                        # we have an issue in fetching the data from the database
+                        fetch_failed = True
                         continue
+                    # terminal.tprint(json.dumps(submission), 'warn')
+
+                    # it seems some submissions don't have a uuid returned with the submission. Use our previous uuid
+                    new_submissions.append(self.init_raw_submission(odk_form, submission, uuid))
+                    known_uuids.add(uuid['_uuid'])
+                    latest_submission = self.latest_submission([submission], latest_submission)
+
+                    if len(new_submissions) >= self.raw_submissions_batch_size():
+                        self.save_raw_submissions(new_submissions)
+                        new_submissions = []
 
                     if settings.DEBUG: progress_bar.progress(subm_count, len(submission_uuids), 'saved')
 
+                self.save_raw_submissions(new_submissions)
+                if len(submission_uuids) != 0 and not fetch_failed and settings.IS_DRY_RUN != True:
+                    # the listing is sorted by the latest submission, so only move the watermark if all were saved
+                    self.update_sync_watermark(odk_form, latest_submission)
+
                 if settings.DEBUG: print('')    # empty line to preserve the progress bar
                 # just check if all is now ok
                 submissions = RawSubmissions.objects.filter(form_id=odk_form.id).order_by('submission_time').values('raw_data')
@@ -424,6 +595,196 @@ class OdkParser():
 
         return submissions
 
+    def bulk_download_ona_submissions(self, odk_form, form_id, known_uuids=None, expected_count=None):
+        """
+        Download the full submissions of an Ona form page by page and save each page in one batch
+
+        Instead of listing the uuids and then fetching every missing submission, the data endpoint is paged
+        using start/limit so that a form with N submissions needs N/ONA_PAGE_SIZE requests.
+        If ODK_FETCH_WORKERS is more than 1 and the number of submissions is known, the pages are fetched concurrently
+        and saved as they arrive. If the form has a sync watermark, only the submissions received since then are fetched
+        and the watermark is moved to the latest submission saved
+
+        Args:
+            odk_form (ODKForm): The local form that the submissions belong to
+            form_id (int): The Ona form id
+            known_uuids (set, optional): The uuids of the submissions of this form which are already saved
+            expected_count (int, optional): The number of submissions to fetch, used to plan the concurrent fetching
+
+        Returns:
+            int: The number of new submissions saved
+        """
+        watermark = self.get_sync_watermark(odk_form)
+        if known_uuids is None:
+            known_uuids = RawSubmissions.objects.filter(form_id=odk_form.id)
+            if watermark is not None:
+                known_uuids = known_uuids.filter(submission_time__gte=watermark)
+            known_uuids = set(known_uuids.values_list('uuid', flat=True))
+
+        page_size = getattr(settings, 'ONA_PAGE_SIZE', 1000)
+        if settings.IS_DRY_RUN == True:
+            page_size = min(page_size, settings.DRY_RUN_RECORDS)
+
+        start = 0
+        saved_count = 0
+        latest_submission = None
+        # the watermark can only be moved if all the pages before the latest saved submission were saved
+        page_failed = False
+        if ConcurrentFetcher.is_enabled() and expected_count and settings.IS_DRY_RUN != True:
+            page_urls = [self.ona_submissions_page_url(form_id, page_start, page_size, watermark) for page_start in range(0, expected_count, page_size)]
+            fetcher = ConcurrentFetcher(self.process_curl_request)
+            for url, page in fetcher.fetch_all(page_urls):
+                if page is None:
+                    page_failed = True
+                elif page:
+                    saved_count += self.save_submissions_page(odk_form, page, known_uuids)
+                    latest_submission = self.latest_submission(page, latest_submission)
+
+            # continue serially in case more submissions came in after they were counted
+            start = len(page_urls) * page_size
+            if settings.DEBUG: terminal.tprint("\tFetched %d pages concurrently, %d new submissions saved" % (len(page_urls), saved_count), 'debug')
+
+        while True:
+            # the pages are parsed as they are received and saved in batches, so a large page is never fully in memory
+            page = self.process_curl_request_stream(self.ona_submissions_page_url(form_id, start, page_size, watermark))
+            if page is None:
+                break
+
+            page_count = 0
+            for submissions in self.iter_batches(page, self.raw_submissions_batch_size()):
+                saved_count += self.save_submissions_page(odk_form, submissions, known_uuids)
+                latest_submission = self.latest_submission(submissions, latest_submission)
+                page_count += len(submissions)
+
+            if page_count == 0:
+                break
+
+            start += page_count
+            if settings.DEBUG: terminal.tprint("\tFetched %d submissions, %d new ones saved so far" % (start, saved_count), 'debug')
+
+            if settings.IS_DRY_RUN == True and start >= settings.DRY_RUN_RECORDS:
+                if settings.DEBUG: terminal.tprint("\tWe have downloaded our maximum number of submissions under dry ran settings", 'info')
+                break
+
+            if page_count < page_size:
+                # we have reached the last page
+                break
+
+        if not page_failed:
+            self.update_sync_watermark(odk_form, latest_submission)
+
+        return saved_count
+
+    def iter_batches(self, items, batch_size):
+        # group the items of an iterator in lists of at most batch_size items
+        items = iter(items)
+        while True:
+            batch = list(itertools.islice(items, batch_size))
+            if len(batch) == 0:
+                return
+            yield batch
+
+    def ona_submissions_page_url(self, form_id, start, page_size, watermark=None):
+        # sort by the submission id so that the pages remain stable as new submissions come in
+        url = "%s/%s%s.json?start=%d&limit=%d&sort=%s" % (self.ona_url, self.form_data, str(form_id), start, page_size, '{"_id":1}')
+        return url + self.ona_watermark_query(watermark)
+
+    def ona_watermark_query(self, watermark):
+        # submissions with the same time as the watermark are fetched again since they might not all have been saved
+        if watermark is None:
+            return ''
+
+        return '&query=%s' % json.dumps({'_submission_time': {'$gte': watermark}})
+
+    def get_sync_watermark(self, odk_form):
+        """
+        Get the submission time of the latest submission saved from the server for this form
+
+        Returns None if the form has never been synced or the form model doesn't have a watermark, in which
+        case all the submissions are fetched
+        """
+        return getattr(odk_form, 'last_synced_time', None)
+
+    def update_sync_watermark(self, odk_form, latest_submission):
+        """
+        Move the form watermark to the latest saved submission
+
+        Args:
+            odk_form (ODKForm): The form being synced
+            latest_submission (tuple): The (_submission_time, _id) of the latest submission saved, as returned by latest_submission
+        """
+        if latest_submission is None or not hasattr(odk_form, 'update_sync_watermark'):
+            return
+
+        odk_form.update_sync_watermark(latest_submission[0], latest_submission[1])
+        if settings.DEBUG: terminal.tprint("\tThe sync watermark of '%s' is now %s" % (odk_form.form_name, latest_submission[0]), 'debug')
+
+    def latest_submission(self, submissions, latest=None):
+        # get the (_submission_time, _id) of the latest of the submissions and the current latest
+        for submission in submissions:
+            cur_submission = (submission['_submission_time'], submission['_id'])
+            if latest is None or cur_submission > latest:
+                latest = cur_submission
+
+        return latest
+
+    def save_submissions_page(self, odk_form, page, known_uuids):
+        """
+        Save a page of full Ona submissions in one batch, skipping the submissions which are already saved
+
+        Args:
+            odk_form (ODKForm): The local form that the submissions belong to
+            page (list): A list of submissions as returned by the Ona data endpoint
+            known_uuids (set): The uuids of the saved submissions. It is updated with the newly saved uuids
+
+        Returns:
+            int: The number of new submissions saved
+        """
+        new_submissions = []
+        for submission in page:
+            if submission['_uuid'] in known_uuids:
+                continue
+            known_uuids.add(submission['_uuid'])
+            new_submissions.append(self.init_raw_submission(odk_form, submission))
+
+        self.save_raw_submissions(new_submissions)
+        return len(new_submissions)
+
+    def save_raw_submissions(self, new_submissions):
+        """
+        Insert a list of unsaved RawSubmissions in batches
+
+        Submissions which have been saved in the meantime (by another sync or under another form) are silently skipped
+        """
+        if len(new_submissions) == 0:
+            return
+
+        with transaction.atomic():
+            RawSubmissions.objects.bulk_create(new_submissions, batch_size=self.raw_submissions_batch_size(), ignore_conflicts=True)
+
+    def raw_submissions_batch_size(self):
+        return getattr(settings, 'RAW_SUBMISSIONS_BATCH_SIZE', 500)
+
+    def init_raw_submission(self, odk_form, submission, listing=None):
+        """
+        Create an unsaved RawSubmissions object from a full Ona submission
+
+        Args:
+            odk_form (ODKForm): The local form that the submission belongs to
+            submission (dict): The full submission as returned by Ona
+            listing (dict, optional): The submission entry from the data listing. If given, its _uuid, _id and _duration are used
+        """
+        meta = submission if listing is None else listing
+        duration = meta.get('_duration', 0)
+        return RawSubmissions(
+            form_id=odk_form.id,
+            uuid=meta['_uuid'],
+            duration=0 if duration in ('', None) or duration < 0 else int(duration),
+            instance_id=meta['_id'],
+            submission_time=submission['_submission_time'],
+            raw_data=submission
+        )
+
     def online_submissions_count(self, form_id):
         # given a form id, process the number of submitted instances
         # terminal.tprint("\tComputing the number of submissions of the form with id '%s'" % form_id, 'info')
@@ -444,8 +805,8 @@ class OdkParser():
                 submissions_count += int(stat['count'])
 
         elif settings.ODK_SERVER == 'odk_central':
-            from .odk_central_parser import OdkCentral
-            central_ = OdkCentral(settings.ODK_URL, settings.ODK_USER, settings.ODK_PASSWORD)
+            from .odk_central_parser import get_central_client
+            central_ = get_central_client(settings.ODK_URL, settings.ODK_USER, settings.ODK_PASSWORD)
             form_det = ODKForm.objects.select_related('form_group').get(form_id=form_id)
             submissions_count = central_.get_submissions_count(form_det.form_group.project_id, form_det.full_form_id)
 
@@ -536,11 +897,11 @@ class OdkParser():
             if settings.ODK_SERVER == 'onadata':
                 url = "%s/%s%d/form.json" % (self.ona_url, self.form_rep, form_id)
                 terminal.tprint("Fetching the form structure for form with id = %d" % form_id, 'header')
-                form_structure = self.process_curl_request(url)
+                form_structure = self.process_cached_curl_request(url)
 
             elif settings.ODK_SERVER == 'odk_central':
-                from .odk_central_parser import OdkCentral
-                central_ = OdkCentral(settings.ODK_URL, settings.ODK_USER, settings.ODK_PASSWORD)
+                from .odk_central_parser import get_central_client
+                central_ = get_central_client(settings.ODK_URL, settings.ODK_USER, settings.ODK_PASSWORD)
                 form_structure = central_.get_form_structure(form_id)
 
                 # once there is the form structure, then at this stage is to create the tree for jqxWidget
@@ -559,7 +920,12 @@ class OdkParser():
             # initialize a current section variable if we are to group them
             self.cur_section = None
 
-            self.top_level_hierarchy = self.extract_repeating_groups(form_structure, 0, True)
+            self.init_dictionary_items()
+            try:
+                self.top_level_hierarchy = self.extract_repeating_groups(form_structure, 0, True)
+                self.save_dictionary_items()
+            finally:
+                self.pending_dictionary_items = None
             self.all_nodes.insert(0, self.top_node)
             terminal.tprint("Processed %d group nodes" % self.cur_node_id, 'warn')
 
@@ -659,6 +1025,46 @@ class OdkParser():
             self.repeat_level -= 1
         return cur_node
 
+    def init_dictionary_items(self):
+        # load the keys of the saved dictionary items of the current form group once, the new items are queued until save_dictionary_items
+        self.dictionary_keys = set(DictionaryItems.objects.filter(form_group=self.cur_form_group).values_list('parent_node', 't_key'))
+        self.pending_dictionary_items = []
+
+    def save_dictionary_items(self):
+        """
+        Save the queued dictionary items in bulk, and to the mapped database if it is defined
+
+        Items which have been saved in the meantime are skipped
+        """
+        if len(self.pending_dictionary_items) == 0:
+            return
+
+        try:
+            DictionaryItems.objects.bulk_create(self.pending_dictionary_items, batch_size=500, ignore_conflicts=True)
+            invalidate_on_commit(DictionaryCache)
+        except Exception as e:
+            sentry.captureException()
+            raise
+
+        if 'mapped' in connections:
+            # add the dictionary items to the final database too. It is expecting that the table exists. The columns are
+            # named in the insert, so they are matched by name whatever their order in the mirror table. date_created and
+            # date_modified are set by bulk_create above
+            insert_q = '''
+                INSERT IGNORE INTO dictionary_items(form_group, parent_node, t_key, t_type, t_locale, t_value, date_created, date_modified)
+                VALUES(%s, %s, %s, %s, %s, %s, %s, %s)
+            '''
+            dict_rows = [(item.form_group, item.parent_node, item.t_key, item.t_type, item.t_locale, item.t_value, item.date_created, item.date_modified) for item in self.pending_dictionary_items]
+            with connections['mapped'].cursor() as cursor:
+                try:
+                    cursor.executemany(insert_q, dict_rows)
+                except Exception as e:
+                    sentry.captureException()
+                    raise
+
+        terminal.tprint("\tSaved %d new dictionary items" % len(self.pending_dictionary_items), 'debug')
+        self.pending_dictionary_items = []
+
     def get_current_section(self, label):
         # get the current section and return it or return None if not found
         m = re.search('^(s\d+p\d+)', label, re.I)
@@ -672,10 +1078,18 @@ class OdkParser():
         if node_type == 'audit':
             return
 
-        # check if this key already exists
-        dict_item = DictionaryItems.objects.filter(form_group=self.cur_form_group, parent_node=parent_node, t_key=node['name'])
+        if self.pending_dictionary_items is None:
+            # we are not extracting a form structure, so save the item straight away
+            self.init_dictionary_items()
+            try:
+                self.add_dictionary_items(node, node_type, parent_node)
+                self.save_dictionary_items()
+            finally:
+                self.pending_dictionary_items = None
+            return
 
-        if dict_item.count() == 0:
+        # check if this key already exists
+        if (parent_node, node['name']) not in self.dictionary_keys:
             # terminal.tprint('\tSaving the node (%s)' % node_type, 'warn')
             # terminal.tprint('\t\t%s' % json.dumps(node), 'okblue')
             node_label = node['label'] if 'label' in node else node['name']
@@ -695,30 +1109,8 @@ class OdkParser():
                 t_locale=locale,
                 t_value=node_label
             )
-            try:
-                dict_item.publish()
-            except IntegrityError as e:
-                # We can live with this
-                terminal.tprint(str(e), 'fail')
-            except Exception as e:
-                sentry.captureException()
-                raise
-
-            if 'mappes' in connections:
-                # add the dictionary item to the final database too. It is expecting that the table exists
-                insert_q = '''
-                    INSERT INTO dictionary_items(form_group, parent_node, t_key, t_type, t_locale, t_value, date_created, date_modified)
-                    VALUES(%s, %s, %s, %s, %s, %s, %s, %s)
-                '''
-                with connections['mapped'].cursor() as cursor:
-                    try:
-                        cursor.execute(insert_q, (self.cur_form_group, parent_node, node['name'], node_type, locale, node_label, now, now))
-                    except IntegrityError as e:
-                        # We can live with this
-                        terminal.tprint(str(e), 'fail')
-                    except Exception as e:
-                        sentry.captureException()
-                        raise
+            self.pending_dictionary_items.append(dict_item)
+            self.dictionary_keys.add((parent_node, node['name']))
 
             if 'type' in node:
                 if node['type'] == 'select one' or node['type'] == 'select all that apply':
@@ -1040,6 +1432,9 @@ class OdkParser():
         Raises:
             Exception: Description
         """
+        # check the format before the errors are reported with the generic message below
+        if not ExcelWriter.is_format_supported(d_format):
+            raise Exception("The data can't be exported as %s files, pyarrow is not installed. Please contact the system administrator." % d_format)
 
         try:
             # print( "Form ID='%s'; Nodes='%s'; Format='%s'; Download Type='%s'; View Name='%s'; Submission Filters='%s'; UUIDS='%s'" % (form_id, nodes, d_format, download_type, view_name, submission_filters, uuids))
@@ -1104,32 +1499,61 @@ class OdkParser():
             self.indexes['main'] = 1
 
             print(json.dumps(associated_forms))
-            for form_id in associated_forms:
-                try:
-                    if submission_filters is not None:
-                        if len(submission_filters) == 0:
-                            submission_filters = None
+            if d_format in ('xlsx', 'parquet') and view_name is None and (download_type != 'submissions' or update_local_data):
+                # only the workbook is needed, so stream the submissions to it without holding them in memory
+                now = datetime.now().strftime('%Y%m%d_%H%M%S')
+                if d_format == 'parquet':
+                    output_name = './' + form_name + '_' + now + '.zip'
+                    writer = ExcelWriter(output_name, 'parquet', column_types=self.get_column_types(associated_forms))
+                else:
+                    output_name = './' + form_name + '_' + now + '.xlsx'
+                    writer = ExcelWriter(output_name)
+                main_rows = self.stream_submissions_to_writer(writer, associated_forms, nodes, uuids, update_local_data, is_dry_run, submission_filters)
+
+                if main_rows == 0 and download_type in ('download_save', 'submissions'):
+                    writer.close_spools()
+                    if settings.DEBUG: terminal.tprint("The form (%s) has no submissions for download" % str(form_name), 'fail')
+                    if download_type == 'download_save':
+                        return {'is_downloadable': False, 'error': False, 'message': "The form (%s) has no submissions for download" % str(form_name)}
+                    return []
+
+                add_main_cols = settings.ADD_MAIN_COLS if hasattr(settings, 'ADD_MAIN_COLS') else []
+                writer.save_spooled_workbook(self.output_structure, add_main_cols)
+                return {'is_downloadable': True, 'filename': output_name}
+
+            if self.use_export_workers(associated_forms):
+                # flatten the form versions in parallel, the results are merged in the order of the forms
+                for (submission, add_cols_data) in self.flatten_forms_in_workers(associated_forms, nodes, uuids, update_local_data, is_dry_run, submission_filters):
+                    all_submissions.append(submission)
+                    if add_cols_data is not None: all_submissions_attrs[submission['unique_id']] = add_cols_data
+            else:
+                for form_id in associated_forms:
+                    try:
+                        if submission_filters is not None:
+                            if len(submission_filters) == 0:
+                                submission_filters = None
                     
-                    if settings.ODK_SERVER == 'onadata':
-                        (this_submissions, submissions_attrs) = self.get_form_submissions_as_json(int(form_id), nodes, uuids, update_local_data, is_dry_run, submission_filters)
-                    elif settings.ODK_SERVER == 'odk_central':
-                        (this_submissions, submissions_attrs) = self.get_form_submissions_as_json(form_id, nodes, uuids, update_local_data, is_dry_run, submission_filters)
+                        if settings.ODK_SERVER == 'onadata':
+                            (this_submissions, submissions_attrs) = self.get_form_submissions_as_json(int(form_id), nodes, uuids, update_local_data, is_dry_run, submission_filters)
+                        elif settings.ODK_SERVER == 'odk_central':
+                            (this_submissions, submissions_attrs) = self.get_form_submissions_as_json(form_id, nodes, uuids, update_local_data, is_dry_run, submission_filters)
 
-                except Exception as e:
-                    # logging.debug(traceback.format_exc())
-                    # logging.error(str(e))
-                    if settings.DEBUG: print((traceback.format_exc()))
-                    terminal.tprint(str(e), 'fail')
-                    sentry.captureException()
-                    # raise Exception(str(e))
-                    continue
+                    except Exception as e:
+                        # logging.debug(traceback.format_exc())
+                        # logging.error(str(e))
+                        if settings.DEBUG: print((traceback.format_exc()))
+                        terminal.tprint(str(e), 'fail')
+                        sentry.captureException()
+                        # raise Exception(str(e))
+                        continue
 
-                if this_submissions is None:
-                    continue
-                else:
-                    # terminal.tprint("\tCurrent no of submissions %d" % len(this_submissions), 'warn')
-                    all_submissions = copy.deepcopy(all_submissions) + copy.deepcopy(this_submissions)
-                    all_submissions_attrs = {**all_submissions_attrs, **submissions_attrs}
+                    if this_submissions is None:
+                        continue
+                    else:
+                        # terminal.tprint("\tCurrent no of submissions %d" % len(this_submissions), 'warn')
+                        # the submissions of each form are new lists, so they are appended without copying
+                        all_submissions.extend(this_submissions)
+                        all_submissions_attrs.update(submissions_attrs)
 
             # terminal.tprint("\tTotal no of submissions %d" % len(all_submissions), 'ok')
             if len(all_submissions) == 0:
@@ -1158,6 +1582,13 @@ class OdkParser():
                 output_name = './' + form_name + '_' + now + '.xlsx'
                 self.save_submissions_as_excel(all_submissions, all_submissions_attrs, self.output_structure, output_name)
                 return {'is_downloadable': True, 'filename': output_name}
+            elif d_format == 'parquet':
+                # a zip with a parquet file for each sheet
+                output_name = './' + form_name + '_' + now + '.zip'
+                writer = ExcelWriter(output_name, 'parquet', column_types=self.get_column_types(associated_forms))
+                add_main_cols = settings.ADD_MAIN_COLS if hasattr(settings, 'ADD_MAIN_COLS') else []
+                writer.create_workbook(all_submissions, self.output_structure, all_submissions_attrs, add_main_cols)
+                return {'is_downloadable': True, 'filename': output_name}
             else:
                 return all_submissions
         
@@ -1166,6 +1597,167 @@ class OdkParser():
             sentry.captureException()
             raise Exception("There was an error while fetching the data. Please contact the system administrator.")
 
+    def stream_submissions_to_writer(self, writer, associated_forms, nodes, uuids=None, update_local_data=True, is_dry_run=True, submission_filters=None):
+        """
+        Flatten the submissions of the associated forms and spool their rows to the writer
+
+        The rows of a form which fails halfway are dropped, as when the forms are processed with get_form_submissions_as_json
+
+        Returns:
+            int: The number of submissions spooled to the main sheet
+        """
+        if submission_filters is not None and len(submission_filters) == 0:
+            submission_filters = None
+
+        main_rows = 0
+        if self.use_export_workers(associated_forms):
+            for (submission, add_cols_data) in self.flatten_forms_in_workers(associated_forms, nodes, uuids, update_local_data, is_dry_run, submission_filters):
+                for sheet_name, row in self.iter_sheet_rows('main', submission, add_cols_data):
+                    writer.add_row(sheet_name, row)
+                main_rows += 1
+
+            return main_rows
+
+        for form_id in associated_forms:
+            checkpoint = writer.checkpoint()
+            form_rows = 0
+            try:
+                if settings.ODK_SERVER == 'onadata':
+                    form_id = int(form_id)
+
+                for sheet_name, row in self.iter_form_submission_rows(form_id, nodes, uuids, update_local_data, is_dry_run, submission_filters):
+                    writer.add_row(sheet_name, row)
+                    if sheet_name == 'main':
+                        form_rows += 1
+            except Exception as e:
+                if settings.DEBUG: print((traceback.format_exc()))
+                terminal.tprint(str(e), 'fail')
+                sentry.captureException()
+                writer.rollback(checkpoint)
+                continue
+
+            main_rows += form_rows
+
+        return main_rows
+
+    def use_export_workers(self, associated_forms):
+        # whether to flatten the associated forms in a process pool. The workers are forked, so they share the parser
+        # state. Within a transaction the forms are flattened serially, the workers can't see its uncommitted changes
+        workers = getattr(settings, 'ODK_EXPORT_WORKERS', 1)
+        if workers <= 1 or len(associated_forms) <= 1 or 'fork' not in multiprocessing.get_all_start_methods():
+            return False
+
+        return not any(conn.in_atomic_block for conn in connections.all())
+
+    def flatten_forms_in_workers(self, associated_forms, nodes, uuids=None, update_local_data=True, is_dry_run=True, submission_filters=None):
+        """
+        Flatten the submissions of the associated forms in a pool of worker processes
+
+        The new submissions are synced from the server by this process before the workers are started, so the
+        workers only read the saved submissions. Each worker spools the flattened submissions of its form to a temporary
+        file, which is read back one submission at a time. The row ids are derived from the submission uuids, so the
+        forms are flattened independently and only their columns need to be merged. A form which fails is skipped, as
+        when the forms are processed serially
+
+        Settings (all optional):
+            ODK_EXPORT_WORKERS: The number of worker processes. Defaults to 1, flattening the forms serially
+
+        Yields:
+            tuple: Each flattened submission and the data of its ADD_MAIN_COLS columns, in the order of the forms
+        """
+        global export_parser
+        if submission_filters is not None and len(submission_filters) == 0:
+            submission_filters = None
+
+        associated_forms = self.sync_forms_submissions(associated_forms, uuids, update_local_data)
+        if len(associated_forms) == 0:
+            return
+
+        base_structure = dict((sheet_name, list(columns)) for sheet_name, columns in six.iteritems(self.output_structure))
+        workers = min(getattr(settings, 'ODK_EXPORT_WORKERS', 1), len(associated_forms))
+
+        export_parser = self
+        futures = []
+        try:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'), initializer=init_export_worker) as executor:
+                futures = [executor.submit(flatten_form_in_worker, form_id, nodes, uuids, is_dry_run, submission_filters, base_structure) for form_id in associated_forms]
+                for future in futures:
+                    try:
+                        (spool_name, structure) = future.result()
+                    except Exception as e:
+                        if settings.DEBUG: print((traceback.format_exc()))
+                        terminal.tprint(str(e), 'fail')
+                        sentry.captureException()
+                        continue
+
+                    if spool_name is None:
+                        continue
+                    try:
+                        self.merge_output_structure(structure)
+                        with open(spool_name, encoding='utf-8') as spool:
+                            for line in spool:
+                                (submission, add_cols_data) = json.loads(line)
+                                yield submission, add_cols_data
+                    finally:
+                        os.unlink(spool_name)
+        finally:
+            export_parser = None
+            # remove the spools of the forms which were not read, in case the export stopped early
+            for future in futures:
+                if future.cancel() or future.exception() is not None:
+                    continue
+                spool_name = future.result()[0]
+                if spool_name is not None and os.path.exists(spool_name):
+                    os.unlink(spool_name)
+
+    def sync_forms_submissions(self, associated_forms, uuids=None, update_local_data=True):
+        # sync the new submissions of the associated forms one form at a time, before the forms are flattened by the
+        # workers. The forms which fail to sync are skipped, as when they are processed serially
+        if not update_local_data or uuids is not None:
+            return list(associated_forms)
+
+        synced_forms = []
+        for form_id in associated_forms:
+            try:
+                self.get_all_submissions(int(form_id) if settings.ODK_SERVER == 'onadata' else form_id, None, True)
+            except Exception as e:
+                if settings.DEBUG: print((traceback.format_exc()))
+                terminal.tprint(str(e), 'fail')
+                sentry.captureException()
+                continue
+            synced_forms.append(form_id)
+
+        return synced_forms
+
+    def merge_output_structure(self, structure):
+        # add the sheets and columns of a form flattened by a worker to the output structure
+        for sheet_name, columns in six.iteritems(structure):
+            if sheet_name not in self.output_structure:
+                self.output_structure[sheet_name] = list(columns)
+                continue
+            sheet_columns = self.get_sheet_columns(sheet_name)
+            for column in columns:
+                if column not in sheet_columns:
+                    self.output_structure[sheet_name].append(column)
+                    sheet_columns.add(column)
+
+    def get_column_types(self, associated_forms):
+        """
+        Get the numeric question types of the columns of the associated forms, used to type the columns of parquet exports
+
+        Returns:
+            dict: The question type (integer, decimal or range) keyed by the column names. Columns with different types
+                in the forms are left out, so they are exported as text
+        """
+        column_types = {}
+        for form_id in associated_forms:
+            for column, column_type in six.iteritems(self.get_flatten_plan(form_id).type_classifier.numeric_columns):
+                if column in column_types and column_types[column] != column_type:
+                    column_type = None
+                column_types[column] = column_type
+
+        return dict((column, column_type) for column, column_type in six.iteritems(column_types) if column_type is not None)
+
     def save_submissions_as_excel(self, submissions, submissions_attrs, structure, filename):
         writer = ExcelWriter(filename)
         add_main_cols = settings.ADD_MAIN_COLS if hasattr(settings, 'ADD_MAIN_COLS') else []
@@ -1206,6 +1798,52 @@ class OdkParser():
             if settings.DEBUG: terminal.tprint("The form with id '%s' has no submissions returning as such" % str(form_id), 'fail')
             return None, None
 
+        submissions = []
+        submissions_attrs = {}
+        for pk_key, data, add_cols_data in self.iter_flattened_submissions(form_id, submissions_list, screen_nodes, is_dry_run, submission_filters):
+            if add_cols_data is not None: submissions_attrs[pk_key] = add_cols_data
+            submissions.append(data)
+
+        return submissions, submissions_attrs
+
+    def iter_form_submission_rows(self, form_id, screen_nodes, uuids=None, update_local_data=True, is_dry_run=True, submission_filters=None):
+        """Given a form id, flatten the form submissions one at a time and yield the rows of each sheet
+
+        The streaming version of get_form_submissions_as_json, only the submission being flattened is held in memory.
+        The rows of a submission are yielded main row first, followed by the rows of its repeats
+
+        Args:
+            form_id (int|string): The form id
+            screen_nodes (list): The nodes to include, None to include all the nodes
+            uuids (None, optional): The uuids of the submissions to include
+            update_local_data (bool, optional): Whether or not to update the local dataset
+            is_dry_run (bool, optional): Whether to limit the submissions to the dry run records
+            submission_filters (dict, optional): The filter criteria of the submissions
+
+        Yields:
+            tuple: The sheet name and the row, a dictionary of values keyed by the column names
+        """
+        submissions_list = self.get_all_submissions(form_id, uuids, update_local_data)
+
+        if submissions_list is None or submissions_list.count() == 0:
+            if settings.DEBUG: terminal.tprint("The form with id '%s' has no submissions returning as such" % str(form_id), 'fail')
+            return
+
+        for pk_key, data, add_cols_data in self.iter_flattened_submissions(form_id, submissions_list, screen_nodes, is_dry_run, submission_filters):
+            yield from self.iter_sheet_rows('main', data, add_cols_data)
+
+    def iter_sheet_rows(self, sheet_name, record, add_cols_data=None):
+        # split a flattened record to the rows of its sheets. The repeats are linked from the record and become rows of their own sheets.
+        # The repeat sheets are added to the output structure while flattening, before the record is split
+        return split_sheet_rows(sheet_name, record, self.output_structure, add_cols_data)
+
+    def iter_flattened_submissions(self, form_id, submissions_list, screen_nodes, is_dry_run=True, submission_filters=None):
+        """Flatten the submissions of a form, one at a time
+
+        Yields:
+            tuple: The submission primary key, the flattened submission and the data of the ADD_MAIN_COLS columns, None
+                if the setting is not defined
+        """
         try:
             # get the form metadata
             # cur_form = ODKForm.objects.get(form_id=form_id)
@@ -1234,22 +1872,23 @@ class OdkParser():
             # ensure the nodes are unique
             screen_nodes = list(set(screen_nodes))
 
-        submissions = []
-        submissions_attrs = {}
+        # compile the flattening rules of this form version, or reuse them if they are already compiled
+        self.flatten_plan = self.get_flatten_plan(form_id)
+
         if submission_filters is not None:
             # create a dictionary which will contain the details of the filters, ie, the short_field_name, full_field_name and the filter criteria
             # terminal.tprint("\tWe are going to filter the data using the criteria: "+ json.dumps(submission_filters), 'debug')
             self.filters_in_detail = {}
         if is_dry_run:
             i = 0
-        for data in submissions_list:
+        # iterate the submissions without caching them in the queryset
+        for data in submissions_list.iterator():
             if is_dry_run:
                 i = i + 1
                 if settings.IS_DRY_RUN and i > settings.DRY_RUN_RECORDS:
                     terminal.tprint("\tWe have processed the maximum number of submissions (%d) under dry ran settings" % i, 'okblue')
                     break
             # data, csv_files = self.post_data_processing(data)
-            pk_key = self.pk_name + str(self.indexes['main'])
             # terminal.tprint(json.dumps(data), 'okblue')
             # if is_dry_run: terminal.tprint(json.dumps(data), 'warn')
 
@@ -1278,11 +1917,13 @@ class OdkParser():
                 # terminal.tprint('Is MySQL db', 'okblue')
                 data = json.loads(data)
 
-            try:
-                data['unique_id'] = pk_key
-            except Exception:
+            if isinstance(data, six.string_types):
                 data = json.loads(data)
-                data['unique_id'] = pk_key
+
+            # the ids of the submission rows are derived from the submission uuid
+            pk_key = self.get_submission_row_id(form_id, data)
+            data['unique_id'] = pk_key
+            self.cur_top_id = pk_key
 
             if submission_filters is not None:
                 # try opportunistic checking if the filter keys are in the top level of the dictionary
@@ -1294,12 +1935,69 @@ class OdkParser():
                 self.cur_add_cols_data = {}
 
             data = self.process_node(data, 'main', screen_nodes, True)
-            if hasattr(settings, 'ADD_MAIN_COLS'): submissions_attrs[pk_key] = self.cur_add_cols_data
+            add_cols_data = self.cur_add_cols_data if hasattr(settings, 'ADD_MAIN_COLS') else None
 
-            submissions.append(data)
             self.indexes['main'] += 1
+            yield pk_key, data, add_cols_data
 
-        return submissions, submissions_attrs
+    def get_submission_row_id(self, form_id, data):
+        """
+        Get the id of the main sheet row of a submission
+
+        The id is the submission uuid prefixed with the PRIMARY_KEY_PREFIX, so it is the same whichever order the
+        submissions are processed in. The repeat rows are identified by the id of their parent, the repeat name and
+        their position in the repeat (see process_list). Submissions without a uuid are numbered within their form in
+        the order they are processed
+        """
+        submission_uuid = None
+        for uuid_key in ('_uuid', '__id', 'meta/instanceID'):
+            if data.get(uuid_key):
+                submission_uuid = data[uuid_key]
+                break
+        else:
+            if isinstance(data.get('meta'), dict):
+                submission_uuid = data['meta'].get('instanceID')
+
+        if submission_uuid:
+            return self.pk_name + re.sub(r'^uuid:', '', str(submission_uuid))
+
+        return '%s%s_%d' % (self.pk_name, str(form_id), self.indexes['main'])
+
+    def get_flatten_plan(self, form_id):
+        # get the flattening plan of the form, compiled for the current form structure and data cleaners
+        processed_structure = ODKForm.objects.filter(form_id=form_id).values_list('processed_structure', flat=True).first()
+        if isinstance(processed_structure, six.string_types):
+            # the structure might be saved as a quoted json string
+            try:
+                processed_structure = json.loads(processed_structure.strip('\''))
+            except ValueError:
+                terminal.tprint("\tCouldn't load the processed structure of the form '%s', the value types will be guessed" % str(form_id), 'warn')
+                processed_structure = None
+
+        structure_digest = hashlib.md5(json.dumps(processed_structure, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+        cleaners_key = json.dumps(self.cleaners, sort_keys=True, default=str) if self.cleaners else None
+        cleaners = self.cleaners
+        return FlattenPlan.get_plan((str(form_id), structure_digest, cleaners_key), lambda: FlattenPlan(TypeClassifier(processed_structure), cleaners))
+
+    def get_interest_set(self, nodes_of_interest):
+        # a set of the nodes of interest, rebuilt if the list is replaced or changed outside process_node
+        if nodes_of_interest is None:
+            return None
+
+        if self.interest_nodes is None or self.interest_nodes[0] is not nodes_of_interest or len(self.interest_nodes[1]) != len(nodes_of_interest):
+            self.interest_nodes = (nodes_of_interest, set(nodes_of_interest))
+
+        return self.interest_nodes[1]
+
+    def get_sheet_columns(self, sheet_name):
+        # a set of the columns of a sheet in the output structure, rebuilt if the structure is replaced or changed elsewhere
+        columns = self.output_structure[sheet_name]
+        cached = self.sheet_columns.get(sheet_name)
+        if cached is None or cached[0] is not columns or len(cached[1]) != len(columns):
+            cached = (columns, set(columns))
+            self.sheet_columns[sheet_name] = cached
+
+        return cached[1]
 
     def determine_submission_filtering(self, data, filters):
         # given the data and the filter criteria, determine if this submission should be included in the final dataset
@@ -1333,34 +2031,37 @@ class OdkParser():
         cur_node = {}
 
         # print('\n%s' % str(node))
+        plan = self.flatten_plan
+        interest_set = self.get_interest_set(nodes_of_interest)
         for key, value in six.iteritems(node):
-            # clean the key
-            clean_key = self.clean_json_key(key)
+            # get the clean key, the data cleaner and the answer type of this key from the plan
+            clean_key, cleaner, answer_type = plan.get_entry(key)
             if clean_key == '_geolocation':
                 continue
 
-            val_type = self.determine_type(value)
+            val_type = plan.classify(value, answer_type)
 
             # terminal.tprint("%s ==> %s" % (key, clean_key), 'okblue')
-            if nodes_of_interest is not None:
-                if clean_key not in nodes_of_interest:
+            if interest_set is not None:
+                if clean_key not in interest_set:
                     # if we have a list or json as the value_type, allow further processing
                     if val_type != 'is_list' and val_type != 'is_json':
                         # logger.warn('%s is not in the nodes of interest -- %s' % (clean_key, json.dumps(nodes_of_interest)))
                         continue
 
             # Check whether there is need to clean the data. If there is need, clean it automatically
-            if clean_key in self.cleaners:
+            if cleaner is not None:
                 # value = self.get_clean_data_value(self.cleaners[clean_key], value, clean_key)
-                value = re.sub(self.cleaners[clean_key]['find'], self.cleaners[clean_key]['replacer'], value)
+                value = plan.clean_value(cleaner, value)
 
             is_json = None
 
             if val_type == 'is_list':
                 # temporarily add the current clean_key to the nodes of interest, to see if there is hidden data in the current node
-                if nodes_of_interest is not None and clean_key not in nodes_of_interest:
+                if interest_set is not None and clean_key not in interest_set:
                     # terminal.tprint('\tTemporarily adding %s to the nodes of interest' % clean_key, 'okblue')
                     nodes_of_interest.append(clean_key)
+                    interest_set.add(clean_key)
                 value = self.process_list(value, clean_key, node['unique_id'], nodes_of_interest, add_top_id)
 
                 if len(self.output_structure[clean_key]) == 3:
@@ -1368,6 +2069,7 @@ class OdkParser():
                     del self.output_structure[clean_key]
                     if nodes_of_interest is not None:
                         nodes_of_interest.remove(clean_key)
+                        interest_set.discard(clean_key)
                     continue
 
                 is_json = False
@@ -1392,8 +2094,8 @@ class OdkParser():
             if is_json is True:
                 if settings.ODK_SERVER == 'odk_central':
                     for n_key, n_value in six.iteritems(value):
-                        n_val_type = self.determine_type(n_value)
-                        n_clean_key = self.clean_json_key(n_key)
+                        n_clean_key, n_cleaner, n_answer_type = plan.get_entry(n_key)
+                        n_val_type = plan.classify(n_value, n_answer_type)
 
                         if n_val_type == 'is_list':
                             value = self.process_list(n_value, n_clean_key, node['unique_id'], nodes_of_interest, add_top_id)
@@ -1419,7 +2121,7 @@ class OdkParser():
             if len(cur_node) != 0:
                 # logger.info('%s: Found something in the current node' % clean_key)
                 if add_top_id is True:
-                    cur_node['top_id'] = self.pk_name + str(self.indexes['main'])
+                    cur_node['top_id'] = self.cur_top_id
 
         # print('\nProcessed node is:')
         # print(json.dumps(cur_node))
@@ -1430,8 +2132,10 @@ class OdkParser():
         Adds a data point to the current sheet
         """
         new_clean_key = self.clean_json_key(new_key) if do_clean_key else new_key
-        if new_clean_key not in self.output_structure[sheet_name]:
+        sheet_columns = self.get_sheet_columns(sheet_name)
+        if new_clean_key not in sheet_columns:
             self.output_structure[sheet_name].append(new_clean_key)
+            sheet_columns.add(new_clean_key)
 
         node[new_clean_key] = new_value
 
@@ -1445,43 +2149,9 @@ class OdkParser():
         """
         determine the input from the user
 
-        @todo, rely on the xls form to get the input type
+        The submission values are classified by the type classifier using the form structure, see TypeClassifier
         """
-        try:
-            float(input) + 2
-        except Exception as e:
-            if isinstance(input, list) is True:
-                return 'is_list'
-            elif input is None:
-                return 'is_none'
-            elif isinstance(input, dict) is True:
-                return 'is_json'
-            elif input == '0E-10':
-                return 'is_zero'
-            else:
-                try:
-                    a = json.loads(input)
-                    if a == False or a == True:
-                        return 'is_string'              # We have false or true values which are strings
-                except ValueError as f:
-                    if isinstance(input, six.string_types) is True:
-                        return 'is_string'
-
-                    terminal.tprint(str(input), 'fail')
-                    return 'is_none'
-                except Exception as g:
-                    # try encoding the input as string
-                    try:
-                        json.loads(str(input))
-                    except ValueError:
-                        return 'is_json'
-                    except Exception:
-                        terminal.tprint(json.dumps(input), 'fail')
-                        return 'is_none'
-                    return 'is_json'
-                return 'is_json'
-
-        return 'is_int'
+        return TypeClassifier.determine_type(input)
 
     def process_list(self, this_list, sheet_name, parent_key, nodes_of_interest, add_top_id):
         # at times the input is a string and not necessary a json object
@@ -1490,12 +2160,12 @@ class OdkParser():
         if sheet_name not in self.output_structure:
             add_cols = settings.ADD_MAIN_COLS if hasattr(settings, 'ADD_MAIN_COLS') else []
             self.output_structure[sheet_name] = ['unique_id', 'top_id', 'parent_id'] + add_cols
-            self.indexes[sheet_name] = 1
 
         cur_list = []
-        for node in this_list:
-            val_type = self.determine_type(node)
-            node['unique_id'] = sheet_name + '_' + str(self.indexes[sheet_name])
+        for index, node in enumerate(this_list, 1):
+            val_type = self.flatten_plan.classify(node, None)
+            # the id of a repeat row is its path from the submission, e.g. hh_<uuid>/animals/2/vaccinations/1
+            node['unique_id'] = '%s/%s/%d' % (parent_key, sheet_name, index)
 
             if val_type == 'is_json':
                 processed_node = self.process_node(node, sheet_name, nodes_of_interest, add_top_id)
@@ -1507,8 +2177,6 @@ class OdkParser():
             else:
                 cur_list.append(node)
 
-            self.indexes[sheet_name] += 1
-
         return cur_list
 
     def post_data_processing(self, data, csv_files):
@@ -1522,8 +2190,7 @@ class OdkParser():
 
     def clean_json_key(self, j_key):
         # given a key from ona with data, get the sane(last) part of the key
-        m = re.findall("/?([\.\w\-]+)$", j_key)
-        return m[0]
+        return clean_json_key(j_key)
 
     def get_clean_data_value(self, cleaner, cur_value, cleaned_field=None):
         try:
@@ -1552,7 +2219,7 @@ class OdkParser():
         # terminal.tprint("\tProcessing API request %s" % url, 'okblue')
         try:
             headers = {'Authorization': "Token %s" % self.ona_api_token}
-            r = requests.get(url, headers=headers)
+            r = self.http_client.get(url, headers=headers)
 
             if r.status_code == 200:
                 # terminal.tprint("\tResponse %d" % r.status_code, 'ok')
@@ -1576,6 +2243,108 @@ class OdkParser():
             sentry.captureException()
             return None
 
+    def process_cached_curl_request(self, url):
+        """
+        Create and execute a conditional curl request, using the saved response if the server says it has not changed
+
+        The ETag and Last-Modified headers of the last response are sent as If-None-Match and If-Modified-Since, so the
+        server only sends the response if it has changed. Set ONA_HTTP_CACHE to False to always fetch the full response
+
+        Returns:
+            The parsed JSON response, or None if the request failed
+        """
+        if not getattr(settings, 'ONA_HTTP_CACHE', True):
+            return self.process_curl_request(url)
+
+        # the responses depend on the user making the request
+        url_hash = hashlib.sha256(('%s %s' % (self.ona_api_token, url)).encode('utf-8')).hexdigest()
+        cached = HttpCache.objects.filter(url_hash=url_hash).first()
+
+        try:
+            headers = {'Authorization': "Token %s" % self.ona_api_token}
+            if cached is not None:
+                if cached.etag: headers['If-None-Match'] = cached.etag
+                if cached.last_modified: headers['If-Modified-Since'] = cached.last_modified
+            r = self.http_client.get(url, headers=headers)
+
+            if r.status_code == 304 and cached is not None:
+                if settings.DEBUG: terminal.tprint("\t%s has not changed, using the saved response" % url, 'debug')
+                return cached.content
+            elif r.status_code == 200:
+                response = r.json()
+                if 'ETag' in r.headers or 'Last-Modified' in r.headers:
+                    HttpCache.objects.update_or_create(url_hash=url_hash, defaults={
+                        'url': url[:2000],
+                        'etag': r.headers.get('ETag'),
+                        'last_modified': r.headers.get('Last-Modified'),
+                        'content': response
+                    })
+                return response
+            elif r.status_code == 404:
+                terminal.tprint("\t%d: Form not found" % r.status_code, 'fail')
+                return None
+            else:
+                terminal.tprint("\tResponse %d" % r.status_code, 'fail')
+                terminal.tprint(r.text, 'fail')
+                terminal.tprint(url, 'warn')
+                return None
+
+        except ConnectionError as e:
+            raise ConnectionError('There was an error while connecting to the ONA server. %s' % str(e))
+
+        except Exception as e:
+            logger.error(traceback.format_exc())
+            logger.info(str(e))
+            sentry.captureException()
+            return None
+
+    def process_curl_request_stream(self, url):
+        """
+        Create and execute a curl request whose response is a JSON list, and parse the list items as they are received
+
+        If ijson is not installed or ONA_STREAM_RESPONSES is False, the whole response is parsed at once
+
+        Returns:
+            iterator: The items of the list, or None if the request failed
+        """
+        if ijson is None or not getattr(settings, 'ONA_STREAM_RESPONSES', True):
+            return self.process_curl_request(url)
+
+        try:
+            headers = {'Authorization': "Token %s" % self.ona_api_token}
+            r = self.http_client.get(url, headers=headers, stream=True)
+
+            if r.status_code == 200:
+                # let urllib3 decompress the gzipped body as it is read
+                r.raw.decode_content = True
+                return self.iter_streamed_items(r)
+            elif r.status_code == 404:
+                terminal.tprint("\t%d: Form not found" % r.status_code, 'fail')
+            else:
+                terminal.tprint("\tResponse %d" % r.status_code, 'fail')
+                terminal.tprint(r.text, 'fail')
+                terminal.tprint(url, 'warn')
+
+            r.close()
+            return None
+
+        except ConnectionError as e:
+            raise ConnectionError('There was an error while connecting to the ONA server. %s' % str(e))
+
+        except Exception as e:
+            logger.error(traceback.format_exc())
+            logger.info(str(e))
+            sentry.captureException()
+            return None
+
+    def iter_streamed_items(self, r):
+        # the connection is only released to the pool once the response is fully read or closed
+        try:
+            for item in ijson.items(r.raw, 'item', use_float=True):
+                yield item
+        finally:
+            r.close()
+
     def get_views_info(self):
         form_views = FormViews.objects.all()
 
@@ -1937,7 +2706,7 @@ class OdkParser():
             # terminal.tprint('\t%s' % json.dumps(self.cur_group_queries), 'warn')
             try:
                 (is_error, comments) = self.process_form_group_data(form_group, is_dry_run, submissions)
-                all_comments = copy.deepcopy(all_comments) + copy.deepcopy(comments)
+                all_comments.extend(comments)
                 top_error = top_error or is_error
             except Exception as e:
                 terminal.tprint('\t%s' % str(e), 'fail')
@@ -2191,9 +2960,8 @@ class OdkParser():
 
         odk_form = list(ODKForm.objects.filter(form_group=form_group.id).values('id', 'form_id'))[0]
 
-        all_nodes = []
-        for (group_name, cur_group) in six.iteritems(self.cur_group_queries):
-            all_nodes = copy.deepcopy(all_nodes) + copy.deepcopy(cur_group['source_datapoints'])
+        # a new list, since the nodes are extended while fetching the data
+        all_nodes = list(itertools.chain.from_iterable(cur_group['source_datapoints'] for cur_group in self.cur_group_queries.values()))
 
         # if we dont have the instance id in the nodes list, include it
         if 'instanceID' not in all_nodes:
@@ -3041,14 +3809,9 @@ class OdkParser():
         """
         Get all the defined system settings
         Returns:
-            list: Returns a list of all the defined system settings
+            dict: Returns a dict of all the defined system settings
         """
-        all_settings = list(SystemSettings.objects.all().values('setting_key', 'setting_value'))
-        to_return = {}
-        for setting in all_settings:
-            to_return[setting['setting_key']] = setting['setting_value']
-
-        return to_return
+        return SettingsCache.get_all()
 
     def is_first_login(self):
         """
@@ -3060,9 +3823,7 @@ class OdkParser():
         with suppress(AttributeError):
             if settings.IGNORE_ONA_DB_SETTINGS: return False
 
-        system_name = SystemSettings.objects.filter(setting_key='system_name')
-
-        return True if len(system_name) == 0 else False
+        return False if 'system_name' in SettingsCache.get_all() else True
 
     def fetch_form_details(self, form_id):
         form = ODKForm.objects.all().filter(id=form_id)
@@ -3140,10 +3901,11 @@ class OdkParser():
             terminal.tprint(str(e), 'fail')
             return True, 'There was an error while saving the group settings'
 
-    def auto_create_form_group(self, full_form_id):
+    def auto_create_form_group(self, full_form_id, saved_groups=None):
         # we are expecting the full form id to have the version number at the end separated with an underscore
         # eg. my_awesome_name_v1, my_awesome_name_v14
         # we process this and extract the my_awesome_name as form name
+        # saved_groups is an optional dict of the saved groups by name, used instead of querying the database
         try:
             if hasattr(settings, 'FORMS_HAVE_PROPER_IDS') and settings.FORMS_HAVE_PROPER_IDS == False:
                 form_group_name = full_form_id
@@ -3154,7 +3916,11 @@ class OdkParser():
 
 
             # check if the group exists first before saving it
-            group = ODKFormGroup.objects.filter(group_name=form_group_name).first()
+            if saved_groups is not None:
+                group = saved_groups.get(form_group_name)
+            else:
+                group = ODKFormGroup.objects.filter(group_name=form_group_name).first()
+
             if group is None:
                 group = ODKFormGroup(
                     order_index=None,
@@ -3162,6 +3928,7 @@ class OdkParser():
                     comments="Auto created from '%s'" % full_form_id
                 )
                 group.publish()
+                if saved_groups is not None: saved_groups[form_group_name] = group
             return group
 
         except Exception as e:
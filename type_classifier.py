@@ -0,0 +1,142 @@
+import json
+
+try:
+    from .terminal_output import Terminal
+except ImportError:
+    from terminal_output import Terminal
+
+terminal = Terminal()
+
+
+class TypeClassifier():
+    """
+    Classify the values of a submission into the types used when flattening the submissions
+
+    The types are those of determine_type: is_int, is_string, is_list, is_json, is_none and is_zero. The question types
+    in the form's processed structure decide up front how the answers of a question are handled, so that strings are
+    not tried as numbers and parsed as json for every value. Values of unknown questions fall back to isinstance checks
+    and, for strings, to determine_type
+    """
+    # question types whose answers are numbers
+    numeric_types = ('integer', 'decimal', 'range')
+
+    # question types whose answers are plain strings, including the xform controls of ODK Central structures
+    text_types = (
+        'text', 'select one', 'select all that apply', 'select_one', 'select_multiple', 'select1', 'select', 'rank',
+        'date', 'datetime', 'time', 'today', 'start', 'end', 'deviceid', 'subscriberid', 'simserial', 'phonenumber',
+        'imei', 'username', 'email', 'barcode', 'geopoint', 'geotrace', 'geoshape', 'image', 'audio', 'video', 'file',
+        'note', 'acknowledge', 'hidden'
+    )
+
+    def __init__(self, processed_structure=None):
+        """
+        Args:
+            processed_structure (list|dict, optional): The processed structure of the form. Either the list of nodes of
+                an Ona form or the dictionary of nodes of an ODK Central form. Without it all the questions are unknown
+        """
+        self.question_types = {}
+        # the numeric question types (integer, decimal or range) of each question name, used to type exported columns
+        self.numeric_columns = {}
+        if processed_structure is not None:
+            self.add_question_types(processed_structure)
+
+    def add_question_types(self, nodes):
+        # get the answer type of each question name. Names used by questions of different types are left as unknown
+        if isinstance(nodes, dict):
+            nodes = [dict(node_, name=node_name) for node_name, node_ in nodes.items() if isinstance(node_, dict) and 'type' in node_]
+
+        for node in nodes:
+            if not isinstance(node, dict):
+                continue
+            if 'items' in node:
+                self.add_question_types(node['items'])
+            if 'name' not in node or 'type' not in node:
+                continue
+
+            if node['type'] in self.numeric_types:
+                answer_type = 'is_int'
+            elif node['type'] in self.text_types:
+                answer_type = 'is_string'
+            else:
+                answer_type = None
+
+            if node['name'] in self.question_types and self.question_types[node['name']] != answer_type:
+                answer_type = None
+            self.question_types[node['name']] = answer_type
+
+            numeric_type = node['type'] if node['type'] in self.numeric_types else None
+            if node['name'] in self.numeric_columns and self.numeric_columns[node['name']] != numeric_type:
+                numeric_type = None
+            self.numeric_columns[node['name']] = numeric_type
+
+    def classify(self, value, clean_key=None):
+        """
+        Get the type of a value
+
+        Args:
+            value: The value to classify
+            clean_key (string, optional): The clean key of the question that the value belongs to
+
+        Returns:
+            string: One of the determine_type types
+        """
+        return self.classify_as(value, self.question_types.get(clean_key))
+
+    def classify_as(self, value, answer_type):
+        # get the type of a value given the answer type of its question, None if the question is unknown
+        if value is None:
+            return 'is_none'
+        elif isinstance(value, list):
+            return 'is_list'
+        elif isinstance(value, dict):
+            return 'is_json'
+        elif isinstance(value, str):
+            if answer_type is not None:
+                return answer_type
+        elif isinstance(value, (bool, int, float)):
+            return 'is_int'
+
+        return self.determine_type(value)
+
+    @staticmethod
+    def determine_type(input):
+        """
+        determine the input from the user
+
+        Tries the input as a number and then as json, so it is slow. Used for the values of unknown questions
+        """
+        try:
+            float(input) + 2
+        except Exception as e:
+            if isinstance(input, list) is True:
+                return 'is_list'
+            elif input is None:
+                return 'is_none'
+            elif isinstance(input, dict) is True:
+                return 'is_json'
+            elif input == '0E-10':
+                return 'is_zero'
+            else:
+                try:
+                    a = json.loads(input)
+                    if a == False or a == True:
+                        return 'is_string'              # We have false or true values which are strings
+                except ValueError as f:
+                    if isinstance(input, str) is True:
+                        return 'is_string'
+
+                    terminal.tprint(str(input), 'fail')
+                    return 'is_none'
+                except Exception as g:
+                    # try encoding the input as string
+                    try:
+                        json.loads(str(input))
+                    except ValueError:
+                        return 'is_json'
+                    except Exception:
+                        terminal.tprint(json.dumps(input), 'fail')
+                        return 'is_none'
+                    return 'is_json'
+                return 'is_json'
+
+        return 'is_int'